@@ -1,30 +1,95 @@
 import dash
+import flask
 import dash_bootstrap_components as dbc
 from dash import dcc, html, dash_table
-from dash.dependencies import Input, Output, State
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+import plotly
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import plotly.subplots as sp
-from datetime import date
+from datetime import date, timedelta
 import pandas as pd
+import numpy as np
+import argparse
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import io
+import itertools
+import json
 import os
+import queue
+import re
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
 import bcrypt
 
 class Carly:
-    def __init__(self, title, db_file) -> None:
-        self.db = DataBase(db_file)
+    # outputs of the callbacks that run without a login, every other callback request needs a session user
+    PUBLIC_OUTPUTS = {'page-content', 'user', 'login-alert', 'logged-in', 'logged-dd', 'login-bttn-div', 'url'}
+    # server routes that need a session user too
+    PRIVATE_ROUTES = {'/metrics', '/query-audit'}
+    # inputs whose value never goes to the slow callback log, only their id
+    SECRET_INPUTS = re.compile(r'pass|user|secret|token|key', re.IGNORECASE)
+
+    def __init__(self, title, db_file, pragmas=None, figure_cache_size=128, figure_cache_bytes=64 * 2**20, typed_arrays=None,
+                 histogram_bins=40, scatter_max_points=5000, series_max_points=500, secret_key=None, bcrypt_rounds=12,
+                 slow_callback_seconds=None, audit_queries=False) -> None:
+        # timings of every callback and sql statement, served on /metrics
+        self.metrics = Metrics()
+        # callbacks slower than this are logged with their input values (credentials redacted), None to never log
+        self.slow_callback_seconds = slow_callback_seconds
+        # query plans that scan vehicles or sort with a temp b-tree, served on /query-audit
+        self.auditor = QueryAuditor() if audit_queries else None
+        self.db = DataBase(db_file, pragmas=pragmas, metrics=self.metrics, auditor=self.auditor)
+        # upper bound on the bars sent to the browser for a numeric field
+        self.histogram_bins = histogram_bins
+        # upper bound on the markers sent to the browser for a scatter of vehicles
+        self.scatter_max_points = scatter_max_points
+        # points of a time series line, for the whole range and again for the zoomed window
+        self.series_max_points = series_max_points
+        # columnar copy of the vehicles, loaded on first use (see the snapshot property)
+        self._snapshot = None
+        self.snapshot_lock = threading.Lock()
+        # figures are cached as their serialized JSON, bounded by count and by bytes
+        self.figure_cache = QueryCache(figure_cache_size, maxbytes=figure_cache_bytes, sizeof=len)
+        # base64 typed arrays for numeric trace data need plotly.js >= 2.28, which comes with plotly 6
+        self.typed_arrays = typed_arrays if typed_arrays is not None else int(plotly.__version__.split('.')[0]) >= 6
+        self.table_cache = QueryCache(figure_cache_size)
+        # 'computed': outputs rebuilt, 'skipped': reused although the data changed, because no write touched their scope,
+        # 'unchanged': reused, no write since; served on /metrics
+        self.recomputes = collections.Counter()
+        self.recomputes_lock = threading.Lock()
+        # undecorated figure bodies by callback name, for benchmarks
+        self.figure_builders = {}
         self.columns = ('ID', 'Type', 'Brand', 'Model', 'Color', 'Fuel', 'Engine', 'HP', 'Doors', 'Sunroof',
                         'Cases', 'Manufacture Year', 'Status', 'Kilometers', 'Price', 'Date Added')
 
-        self.user_db = UserDB(db_file)
-        self.user = None
+        self.user_db = UserDB(db_file, pool=self.db.pool, rounds=bcrypt_rounds)
         
         self.app = dash.Dash(external_stylesheets=[dbc.themes.FLATLY, dbc.icons.FONT_AWESOME])
+        # the login lives in a signed session cookie, every worker process sharing the database shares the key
+        self.app.server.secret_key = secret_key or os.environ.get('CARLY_SECRET_KEY') or self.db.setting('secret_key')
+        self.app.server.before_request(self.start_callback_timer)
+        self.app.server.before_request(self.login_guard)
+        self.app.server.after_request(self.record_callback)
+        self.app.server.route('/metrics')(self.metrics_page)
+        if self.auditor is not None:
+            self.app.server.route('/query-audit')(self.query_audit_page)
         self.app.config.suppress_callback_exceptions = True
         self.app.title = title
         self.app.layout = html.Div([
-            dcc.Store(id='cache', storage_type='memory'),   #exists only to trigger callbacks (useless value)
             dcc.Store(id='user', storage_type='memory', data=0), #0: no user, -1: incorrect credentials, >0: user logged in
             dcc.Location(id='url', refresh=False),
             html.Div(id='navbar', children=self.make_navbar()),
@@ -33,6 +98,77 @@ class Carly:
 
         self.callbacks(self.app)
 
+    @property
+    def user(self):
+        # username logged in by the current request's session, None outside of a request
+        return flask.session.get('user') if flask.has_request_context() else None
+
+    @property
+    def snapshot(self):
+        # only the kilometers per manufacture year scatter reads it, so a worker that never draws it never loads it
+        if self._snapshot is None:
+            with self.snapshot_lock:
+                if self._snapshot is None:
+                    self._snapshot = VehicleSnapshot(self.db)
+        return self._snapshot
+
+    def login_guard(self):
+        # server side check of the callbacks: only the login and page routing ones run without a session user
+        if self.user:
+            return None
+        if flask.request.path in self.PRIVATE_ROUTES:
+            flask.abort(403)
+        if not flask.request.path.endswith('/_dash-update-component'):
+            return None
+        outputs = (flask.request.get_json(silent=True) or {}).get('outputs', [])
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        if all(isinstance(o, dict) and o.get('id') in self.PUBLIC_OUTPUTS for o in outputs):
+            return None
+        flask.abort(403)
+
+    def start_callback_timer(self):
+        if flask.request.path.endswith('/_dash-update-component'):
+            flask.g.callback_start = time.perf_counter()
+            self.metrics.begin()
+
+    def record_callback(self, response):
+        # latency, sql rows and response bytes of the callback, named after its function
+        start = flask.g.pop('callback_start', None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        body = flask.request.get_json(silent=True) or {}
+        callback = self.app.callback_map.get(body.get('output'), {}).get('callback')
+        name = getattr(callback, '__name__', None) or body.get('output', 'unknown')
+        self.metrics.observe('callback', name, seconds, rows=self.metrics.end(), size=response.calculate_content_length() or 0)
+        if self.slow_callback_seconds is not None and seconds > self.slow_callback_seconds:
+            # input values without credentials, state (form fields, stored versions) by id only
+            inputs = {'{}.{}'.format(i.get('id'), i.get('property')):
+                      '<redacted>' if self.SECRET_INPUTS.search(str(i.get('id'))) else i.get('value')
+                      for i in body.get('inputs', []) if isinstance(i, dict)}
+            state = ['{}.{}'.format(i.get('id'), i.get('property')) for i in body.get('state', []) if isinstance(i, dict)]
+            self.app.server.logger.warning('slow callback %s: %.3fs, inputs %s, state %s', name, seconds,
+                                           json.dumps(inputs, default=str)[:2000], ', '.join(state))
+        return response
+
+    def metrics_page(self):
+        # Prometheus text format, plus the hit rates of the caches
+        lines = ['# HELP carly_cache_requests_total Cache lookups by result.', '# TYPE carly_cache_requests_total counter']
+        for cache_name, cache in (('figure', self.figure_cache), ('table', self.table_cache), ('query', self.db.cache)):
+            stats = cache.stats()
+            lines += ['carly_cache_requests_total{{cache="{}",result="{}"}} {}'.format(cache_name, result, stats[key])
+                      for result, key in (('hit', 'hits'), ('miss', 'misses'))]
+        lines += ['# HELP carly_output_recomputes_total Scoped callback outputs by whether they were rebuilt.',
+                  '# TYPE carly_output_recomputes_total counter']
+        with self.recomputes_lock:
+            recomputes = dict(self.recomputes)
+        lines += ['carly_output_recomputes_total{{outcome="{}"}} {}'.format(outcome, recomputes.get(outcome, 0))
+                  for outcome in ('computed', 'skipped', 'unchanged')]
+        return flask.Response(self.metrics.render() + '\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    def query_audit_page(self):
+        return flask.Response(self.auditor.report(), mimetype='text/plain')
+
     def make_navbar(self):
         navbar = dbc.Navbar(
             html.Div([
@@ -321,12 +457,22 @@ class Carly:
             is_open=False,
         )
 
+        import_upload = html.Div([
+            dcc.Upload(
+                html.Div(['Bulk import: drag and drop or ', html.A('select a CSV file')]),
+                id='import-upload',
+                accept='.csv,.gz',
+                className='import-upload mb-3',
+            ),
+            dbc.Alert(id='import-alert', is_open=False, dismissable=True),
+        ])
+
         insert_layout = html.Div([
             html.H1('Insert'),
             error_modal,
             choose_modal,
             success_modal,
-            dbc.Col(insert_form, md=8, xl=5)
+            dbc.Col([import_upload, insert_form], md=8, xl=5)
         ])
 
         return insert_layout
@@ -334,7 +480,6 @@ class Carly:
     def database_layout(self):
         database_layout = html.Div([
             html.H1('Database'),
-            dcc.Download(id='download-csv'),
             dbc.Row([
                 dbc.Col(
                     dbc.Checklist(
@@ -354,15 +499,27 @@ class Carly:
                         placement='top',
                     ),
                     ], id='custom-filter-col', width=4),
-                dbc.Col(dbc.Button('Download', id='download-button'), id='download-button-col')
+                dbc.Col([
+                    dbc.Checklist(
+                        options=[{'label': 'gzip', 'value': 'gzip'}],
+                        id='download-gzip',
+                        switch=True,
+                        inline=True),
+                    dbc.Button('Download', id='download-button', href='/download/database.csv', external_link=True),
+                ], id='download-button-col')
             ], id='database-options'),            
+            dbc.Alert(id='filter-alert', color='warning', is_open=False),
             dash_table.DataTable(
                 id='db-table',
                 columns=[{'name': i, 'id': i} for i in self.columns],
                 style_cell_conditional=[ {'if': {'column_id': c}, 'textAlign': 'left'} for c in ('Type','Brand','Model','Color','Fuel','Sunroof','Status') ],
                 style_data_conditional=[{'if': {'row_index': 'odd'}, 'backgroundColor': '#f0f0f0',}],
-                page_action='native',
+                page_action='custom',
+                page_current=0,
                 page_size=100,
+                sort_action='none',
+                sort_mode='multi',
+                filter_action='none',
             ),
         ])
 
@@ -382,7 +539,10 @@ class Carly:
                 inline=True,
             )
 
+        # the date picker starts at the first vehicle added
+        first_date = self.first_date()
         tab1 = dcc.Tab(
+            value='tab1',
             label='Vehicles Added per Date',
             children=[
                 html.Br(),
@@ -408,6 +568,8 @@ class Carly:
                 dcc.DatePickerRange(
                     id='my-date-picker-range',
                     display_format='DD/MM/YY',
+                    min_date_allowed=first_date,
+                    start_date=first_date,
                     max_date_allowed=date.today(),
                     end_date=date.today()
                 ),
@@ -417,6 +579,7 @@ class Carly:
         )
 
         tab2 = dcc.Tab(
+            value='tab2',
             label='Vehicles Added (Range Slider)',
             children=[
                 html.Br(),
@@ -426,6 +589,7 @@ class Carly:
         )
 
         tab3 = dcc.Tab(
+            value='tab3',
             label='Percentage per Type & Fuel',
             children=[
                 html.Br(),
@@ -435,6 +599,7 @@ class Carly:
         )
 
         tab4 = dcc.Tab(
+            value='tab4',
             label='Km Per Manuf. Year',
             children=[
                 html.Br(),
@@ -445,15 +610,17 @@ class Carly:
         )
 
         tab5 = dcc.Tab(
+            value='tab5',
             label='Percentage per Price Range',
             children=[
                 html.Br(),
-                html.H3('Percentage of Vehicles per Price Range (10k€ intervals)', className='centered-title'),
+                html.H3('Percentage of Vehicles per Price Range', className='centered-title'),
                 dcc.Graph(id='price-range-pie', config={'displayModeBar': False}),
             ],
         )
 
         tab6 = dcc.Tab(
+            value='tab6',
             label='Average Price per Type',
             children=[
                 html.Br(),
@@ -463,6 +630,7 @@ class Carly:
         )
 
         tab7 = dcc.Tab(
+            value='tab7',
             label='Average Price per Brand',
             children=[
                 html.Br(),
@@ -473,6 +641,7 @@ class Carly:
         )
 
         tab8 = dcc.Tab(
+            value='tab8',
             label='Maximum Engine per Brand',
             children=[
                 html.Br(),
@@ -482,6 +651,7 @@ class Carly:
         )
 
         tab9 = dcc.Tab(
+            value='tab9',
             label='Count per Color',
             children=[
                 html.Br(),
@@ -491,6 +661,7 @@ class Carly:
         )
 
         tab10 = dcc.Tab(
+            value='tab10',
             label='Count per Field',
             children=[
                 html.Br(),
@@ -512,10 +683,16 @@ class Carly:
             ],
         )
 
+        # last data version each graph was drawn with, so revisiting a tab doesn't redraw it
+        versions = [dcc.Store(id='{}-version'.format(g), storage_type='memory') for g in (
+            'count-date', 'count-rangeslider', 'count-typefuel', 'km-per-manyear', 'price-range-pie',
+            'avg-price-per-type-status', 'avg-price-per-brand', 'max-engine-per-brand', 'count-color', 'count-per-typefield')]
+
         charts_layout = html.Div([
             html.H1('Charts'),
+            html.Div(versions),
             html.Div([
-                dcc.Tabs([
+                dcc.Tabs(id='chart-tabs', value='tab1', children=[
                     tab1,
                     tab2,
                     tab3,
@@ -526,21 +703,160 @@ class Carly:
                     tab8,
                     tab9,
                     tab10,
-                ],)
+                ])
             ])
         ])
 
         return charts_layout
 
+    @staticmethod
+    def bin_label(low, high) -> str:
+        short = lambda x: '{:g}k'.format(x / 1000) if abs(x) >= 1000 else '{:g}'.format(x)
+        return '[{}, {})'.format(short(low), short(high))
+
+    @staticmethod
+    def downsample(x, y, points) -> np.ndarray:
+        # indexes kept by Largest-Triangle-Three-Buckets: the first and last point, and per bucket the point
+        # spanning the largest triangle with the previously kept point and the mean of the next bucket
+        n = len(x)
+        if n <= points or points < 3:
+            return np.arange(n)
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+        keep = np.empty(points, dtype=np.int64)
+        keep[0], keep[-1] = 0, n - 1
+        for i in range(points - 2):
+            low, high = edges[i], edges[i + 1]
+            following = slice(high, edges[i + 2] if i + 2 < len(edges) else n)
+            mean_x, mean_y = x[following].mean(), y[following].mean()
+            prev_x, prev_y = x[keep[i]], y[keep[i]]
+            area = np.abs((prev_x - mean_x) * (y[low:high] - prev_y) - (prev_x - x[low:high]) * (mean_y - prev_y))
+            keep[i + 1] = low + np.argmax(area)
+        return keep
+
+    @staticmethod
+    def zoomed_figure(func):
+        # passes the graph's relayoutData (last argument) on as a hashable (start, end) of the zoomed x axis, None when not zoomed
+        def window(relayout):
+            relayout = relayout or {}
+            if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+                return str(relayout['xaxis.range[0]'])[:10], str(relayout['xaxis.range[1]'])[:10]
+            if 'xaxis.range' in relayout:
+                return tuple(str(x)[:10] for x in relayout['xaxis.range'])
+            return None
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            *args, relayout = args
+            triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+            if triggered and all(t.endswith('.relayoutData') for t in triggered) and window(relayout) is None \
+                    and not (relayout or {}).get('xaxis.autorange'):
+                # e.g. autosize, nothing to redraw
+                raise PreventUpdate
+            return func(*args, window(relayout))
+        wrapper.version = lambda *args: func.version(*args[:-1], window(args[-1]))
+        return wrapper
+
+    def type_scope(self, selected_type) -> tuple:
+        return ('type = ?', [selected_type]) if selected_type in ('Car', 'Motorbike') else ('', [])
+
+    def first_date(self) -> str:
+        # lower bound of the date picker, read again only after a write
+        return self.cached_output(self.table_cache, ('first_date',), '', [], lambda: self.db.get_min_of('date'))[0]
+
+    def cached_output(self, cache, key, condition, params, compute):
+        # reuses an output until a write touches the rows it depends on (condition, see DataBase.scope_version)
+        version = self.db.scope_version(condition, params)
+        computed = []
+
+        def run():
+            computed.append(True)
+            return compute()
+
+        value = cache.get(key + (version,), run)
+        if computed:
+            outcome = 'computed'
+        elif version != self.db.scope_version():
+            outcome = 'skipped'
+        else:
+            outcome = 'unchanged'
+        with self.recomputes_lock:
+            self.recomputes[outcome] += 1
+        return value, version
+
+    # plotly.js typed array dtypes, int64 has none
+    TYPED_ARRAYS = {'float64': 'f8', 'float32': 'f4', 'int32': 'i4', 'uint32': 'u4', 'int16': 'i2', 'uint16': 'u2',
+                    'int8': 'i1', 'uint8': 'u1'}
+
+    @classmethod
+    def typed_array(cls, value):
+        # numeric 1d arrays anywhere in a trace become {'dtype', 'bdata'} typed arrays, everything else is left as is
+        if isinstance(value, dict):
+            return {k: cls.typed_array(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [cls.typed_array(v) for v in value]
+        if not isinstance(value, np.ndarray) or value.ndim != 1 or value.dtype.kind not in 'iuf' or not len(value):
+            return value
+        if value.dtype.kind in 'iu' and value.dtype.name not in cls.TYPED_ARRAYS:
+            fits = np.iinfo(np.int32).min <= value.min() and value.max() <= np.iinfo(np.int32).max
+            value = value.astype(np.int32 if fits else np.float64)
+        dtype = cls.TYPED_ARRAYS[value.dtype.name]
+        return {'dtype': dtype, 'bdata': base64.b64encode(value.astype(value.dtype.newbyteorder('<')).tobytes()).decode('ascii')}
+
+    def figure_json(self, fig) -> str:
+        # compact JSON of a figure, with the numeric trace data as typed arrays when enabled
+        figure = fig.to_plotly_json()
+        if self.typed_arrays:
+            figure['data'] = [self.typed_array(trace) for trace in figure['data']]
+        return pio.to_json(figure, validate=False)
+
+    def cached_figure(self, scope=None):
+        # scope(*args) returns the (condition, params) of the vehicles the figure depends on, None for all
+        def decorator(func):
+            def scope_of(*args):
+                return (scope(*args) if scope else None) or ('', [])
+
+            def version(*args):
+                return self.db.scope_version(*scope_of(*args))
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                condition, params = scope_of(*args)
+                # a hit skips building the figure and plotly's validation and encoding,
+                # the parsed JSON is plain lists and strings that dash encodes cheaply
+                serialized = self.cached_output(self.figure_cache, (func.__name__, args), condition, params,
+                                                lambda: self.figure_json(func(*args)))[0]
+                return json.loads(serialized)
+            wrapper.version = version
+            self.figure_builders[func.__name__] = func
+            return wrapper
+        return decorator
+
+    def lazy_figure(self, tab):
+        # only the active tab's chart is computed, the callback gets two extra trailing
+        # arguments (active tab, version the figure was drawn with) and returns the new version
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args):
+                *args, active_tab, drawn_version = args
+                if active_tab != tab:
+                    raise PreventUpdate
+                version = func.version(*args)
+                triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+                if triggered == ['chart-tabs.value'] and drawn_version == version:
+                    # tab shown again and its figure is still current
+                    raise PreventUpdate
+                return func(*args), version
+            return wrapper
+        return decorator
+
     def callbacks(self, app):
-        @app.callback(
+        # pure UI state is handled in the browser, see assets/clientside.js
+        app.clientside_callback(
+            ClientsideFunction('carly', 'toggle_navbar_collapse'),
             Output('navbar-collapse', 'is_open'),
             Input('navbar-toggler', 'n_clicks'),
             State('navbar-collapse', 'is_open'))
-        def toggle_navbar_collapse(n_clicks, is_open):
-            if n_clicks:
-                return not is_open
-            return is_open
 
         @app.callback(
             Output('page-content', 'children'),
@@ -562,18 +878,21 @@ class Carly:
                 return self.error404_layout()
 
         @app.callback(
-            [Output('user', 'data'), Output('login-alert', 'is_open')],
+            [Output('user', 'data'), Output('login-alert', 'is_open'), Output('login-alert', 'children')],
             Input('login-page-bttn', 'n_clicks'),
             [State('username', 'value'), State('password', 'value')],
             prevent_initial_call=True)
         def login(login, username, password):
             if login and not self.user:
                 if username and password:
-                    if self.user_db.check_password(username, password):
-                        self.user = username
-                        return 1, False
-                return -1, True
-            return 0, False
+                    try:
+                        if self.user_db.check_password(username, password):
+                            flask.session['user'] = username
+                            return 1, False, dash.no_update
+                    except UserDB.Throttled as e:
+                        return -1, True, str(e)
+                return -1, True, 'Incorrect credentials!'
+            return 0, False, dash.no_update
 
         @app.callback(
             [Output('logged-in', 'hidden'), Output('logged-dd', 'label'), Output('login-bttn-div', 'hidden'), Output('url', 'pathname')],
@@ -582,7 +901,7 @@ class Carly:
         def logout(user_data, logout, url):
             triggered_id = dash.callback_context.triggered[0]['prop_id']
             if 'logout.n_clicks' == triggered_id and logout:
-                self.user = None
+                flask.session.pop('user', None)
                 return True, None, False, '/'
             if self.user:
                 if user_data > 0 or url == '/login':
@@ -594,19 +913,13 @@ class Carly:
             # if not logged in: don't redirect
             return True, None, False, dash.no_update
 
-        @app.callback(
+        app.clientside_callback(
+            ClientsideFunction('carly', 'disable_inputs'),
             [Output('doors-input', 'disabled'), Output('sunroof-input', 'disabled'), Output('cases-input', 'disabled')],
             Input('type-input', 'value'))
-        def disable_inputs(veh_type):
-            if veh_type == 'Car':
-                return False, False, True
-            elif veh_type == 'Motorbike':
-                return True, True, False
-            else:
-                return True, True, True
 
         @app.callback(
-            [Output('cache', 'data'), Output('error-modal', 'is_open'), Output('choose-modal', 'is_open'), Output('same-table', 'data'), Output('success-modal', 'is_open')],
+            [Output('error-modal', 'is_open'), Output('choose-modal', 'is_open'), Output('same-table', 'data'), Output('success-modal', 'is_open')],
             [Input('submit-bttn', 'n_clicks'), Input('choose-modal', 'is_open'), Input('modal-select', 'n_clicks'), Input('modal-cancel', 'n_clicks'),],
             [State('type-input', 'value'), State('brand-input', 'value'), State('model-input', 'value'), State('color-input', 'value'),
             State('fuel-input', 'value'), State('engine-input', 'value'), State('hp-input', 'value'), State('doors-input', 'value'),
@@ -628,125 +941,192 @@ class Carly:
                 select = list(range(len(table_data)-1))
                 return modal_form(select, table_data)
             else:
-                return False, False, False, None, False
+                return False, False, None, False
 
         def submit_form(type, brand, model, color, fuel, engine, hp, doors, sunroof, cases, manyear, status, km, price):    
             if not type:
-                return False, True, False, None, False
+                return True, False, None, False
             elif type == 'Car' and None in (type, brand, model, color, fuel, engine, hp, doors, sunroof, manyear, status, km, price):
-                return False, True, False, None, False
+                return True, False, None, False
             elif type == 'Motorbike' and None in (type, brand, model, color, fuel, engine, hp, cases, manyear, status, km, price):
-                return False, True, False, None, False
-            
-            id = self.db.get_max_of('id') + 1
-            date_added = self.db.get_curr_date()
-            veh_tup = (id, type, brand, model, color, fuel, engine, hp, doors, sunroof, cases, manyear, status, km, price, date_added)
+                return True, False, None, False
             
+            # id and date are left to the database so that concurrent submissions can't collide
+            veh_tup = (None, type, brand, model, color, fuel, engine, hp, doors, sunroof, cases, manyear, status, km, price, None)
             
-            similar_df = pd.DataFrame(self.db.find_similar('similars', veh_tup), columns=self.columns)
-            self.db.drop_table('similars')
+            similar_df = pd.DataFrame(self.db.find_similar(veh_tup), columns=self.columns)
             if len(similar_df) > 1:
-                return True, False, True, similar_df.to_dict('records'), False
+                return False, True, similar_df.to_dict('records'), False
 
             self.db.add_row(veh_tup)
-            return True, False, False, None, True
+            return False, False, None, True
 
         def modal_form(selected, table_data):
-            keep_rows = [tuple(table_data[i].values()) for i in selected]
-            dont_keep_rows = [tuple(table_data[i].values()) for i in range(len(table_data)) if i not in selected]
+            selected = set(selected)
+            keep_rows = [tuple(table_data[i][c] for c in self.columns) for i in selected]
+            dont_keep_rows = [tuple(table_data[i][c] for c in self.columns) for i in range(len(table_data)) if i not in selected]
 
-            for keeper in keep_rows:
-                self.db.add_row(keeper)
-            for not_keeper in dont_keep_rows:
-                self.db.delete_row(not_keeper)
-
-            return True, False, False, None, True
+            self.db.apply_changes(keep_rows, dont_keep_rows)
+            return False, False, None, True
 
         @app.callback(
-            Output('db-table', 'data'),
-            Input('cache', 'data'))
-        def update_table(cache):
-            df = pd.DataFrame(self.db.get_all(), columns=self.columns)
-            return df.to_dict('records')
+            [Output('import-alert', 'children'), Output('import-alert', 'color'), Output('import-alert', 'is_open')],
+            Input('import-upload', 'contents'),
+            State('import-upload', 'filename'),
+            prevent_initial_call=True)
+        def import_upload(contents, filename):
+            if not contents:
+                return None, 'secondary', False
+            # the browser sends the whole file base64 encoded in one request, it is decoded to a temp file
+            # in 1 MiB chunks so the server doesn't hold a second, decoded copy next to it
+            # the temp file is closed, and so deleted, on every way out of the with block
+            with tempfile.TemporaryFile() as f:
+                try:
+                    chunk = 4 * 2**18
+                    for start in range(contents.index(',') + 1, len(contents), chunk):
+                        f.write(base64.b64decode(contents[start:start + chunk]))
+                    f.seek(0)
+                    report = self.db.import_csv(f, compression='gzip' if filename.endswith('.gz') else None)
+                except (ValueError, OSError, EOFError, pd.errors.ParserError) as e:
+                    # e.g. bad base64 (binascii.Error is a ValueError), a corrupt or truncated .gz, a disk full
+                    return 'Import of {} failed: {}'.format(filename, e), 'danger', True
+
+            message = ['Imported {rows} vehicles in {seconds:.1f}s ({rows_per_second:.0f} rows/s).'.format(**report)]
+            if report['rejected']:
+                message += [html.Br(), 'Rejected {} rows, e.g. '.format(report['rejected']),
+                            ', '.join('line {}: {}'.format(line, reason) for line, reason in report['errors'][:5])]
+            return message, 'warning' if report['rejected'] else 'success', True
 
         @app.callback(
+            [Output('db-table', 'data'), Output('db-table', 'page_count'), Output('db-table', 'page_current'),
+            Output('filter-alert', 'children'), Output('filter-alert', 'is_open')],
+            [Input('db-table', 'page_current'),
+            Input('db-table', 'page_size'),
+            Input('db-table', 'sort_by'),
+            Input('db-table', 'filter_query'),
+            Input('db-table', 'sort_action'),
+            Input('db-table', 'filter_action')])
+        def update_table(page_current, page_size, sort_by, filter_query, sort_action, filter_action):
+            # paging, sorting and filtering happen in sql so only one page leaves the server
+            sort_by = sort_by if sort_action == 'custom' else None
+            filter_query = filter_query if filter_action == 'custom' else ''
+            try:
+                condition, params = self.db.parse_filter(filter_query or '')
+            except ValueError as e:
+                # half-typed or invalid query: the table keeps its last rows, the alert says why
+                return dash.no_update, dash.no_update, dash.no_update, 'Invalid filter: {}'.format(e), True
+            triggered = {t['prop_id'] for t in dash.callback_context.triggered}
+            # another order or another set of rows starts again at the first page
+            reset = triggered & {'db-table.sort_by', 'db-table.filter_query', 'db-table.sort_action', 'db-table.filter_action'}
+            requested = 0 if reset else page_current or 0
+
+            def compute():
+                count = self.db.count_rows(filter_query)
+                page_count = max(1, -(-count // page_size))
+                # e.g. rows deleted since the page was shown: the last page instead of an empty one
+                page = min(requested, page_count - 1)
+                rows = self.db.get_page(page, page_size, filter_query, sort_by)
+                df = pd.DataFrame(rows, columns=self.columns)
+                return df.to_dict('records'), page_count, page
+
+            # only writes to rows matching the filter can change this page
+            key = ('update_table', requested, page_size, filter_query, json.dumps(sort_by))
+            data, page_count, page = self.cached_output(self.table_cache, key, condition, params, compute)[0]
+            return data, page_count, page if page != page_current else dash.no_update, None, False
+
+        app.clientside_callback(
+            ClientsideFunction('carly', 'style_active_row'),
             Output('db-table', 'style_data_conditional'),
             Input('db-table', 'active_cell'),
             State('db-table', 'style_data_conditional'))
-        def style_active_row(active_cell, style_cond):
-            if not active_cell:
-                return style_cond
-                
-            active_row_id = active_cell['row']
-            new_style_cond = [d for d in style_cond if not (d['backgroundColor'] == '#ff413633')]
-            new_style_cond.append({'if': {'row_index': active_row_id}, 'backgroundColor': '#ff413633',})
-            return new_style_cond
-        
-        @app.callback(
+
+        app.clientside_callback(
+            ClientsideFunction('carly', 'filter_sort_action'),
             [Output('db-table', 'sort_action'),
             Output('db-table', 'filter_action'),
             Output('custom-filter-input', 'disabled')],
-            Input('table-switch', 'value'),)
-        def filter_sort_action(switch):
-            to_sort = 'none'
-            to_filter = 'none', True
-            if not switch:
-                return to_sort, *to_filter
-            
-            if 'Sort' in switch:
-                to_sort = 'native'
-            if 'Filter' in switch:
-                to_filter = 'native', False
-            return to_sort, *to_filter
+            Input('table-switch', 'value'))
 
-        @app.callback(
+        app.clientside_callback(
+            ClientsideFunction('carly', 'write_query'),
             Output('db-table', 'filter_query'),
             Input('custom-filter-input', 'value'))
-        def write_query(query):
-            if query is None:
-                return ''
-            return query
 
         @app.callback(
-            Output('download-csv', 'data'),
-            Input('download-button', 'n_clicks'),
-            prevent_initial_call=True)
-        def export_csv(n_clicks):
-            df = pd.DataFrame(self.db.get_all(), columns=self.columns)
-            return dcc.send_data_frame(df.to_csv, 'database.csv', index=False, header=True, columns=self.columns)
+            Output('download-button', 'href'),
+            [Input('db-table', 'sort_by'),
+            Input('db-table', 'filter_query'),
+            Input('db-table', 'sort_action'),
+            Input('db-table', 'filter_action'),
+            Input('download-gzip', 'value')])
+        def export_link(sort_by, filter_query, sort_action, filter_action, gzip):
+            # the download itself is streamed by the /download route, see export_csv
+            params = {}
+            if filter_action == 'custom' and filter_query:
+                params['filter'] = filter_query
+            if sort_action == 'custom' and sort_by:
+                params['sort'] = json.dumps(sort_by)
+            if gzip:
+                params['gzip'] = 1
+            name = 'database.csv.gz' if gzip else 'database.csv'
+            return '/download/{}?{}'.format(name, urllib.parse.urlencode(params)) if params else '/download/' + name
+
+        @app.server.route('/download/<name>')
+        def export_csv(name):
+            # streams the (filtered, sorted) table in chunks so memory stays flat for any table size
+            if not self.user:
+                flask.abort(403)
+            filter_query = flask.request.args.get('filter', '')
+            compress = bool(flask.request.args.get('gzip'))
+            try:
+                self.db.parse_filter(filter_query)
+            except ValueError:
+                filter_query = ''
+            try:
+                sort_by = json.loads(flask.request.args.get('sort', '[]'))
+            except ValueError:
+                sort_by = []
+
+            def generate():
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                gzipper = zlib.compressobj(wbits=31) if compress else None  # 31: gzip container
+
+                def flush():
+                    data = buffer.getvalue().encode()
+                    buffer.seek(0)
+                    buffer.truncate()
+                    return gzipper.compress(data) if gzipper else data
+
+                writer.writerow(self.columns)
+                for rows in self.db.iter_rows(filter_query, sort_by):
+                    writer.writerows(rows)
+                    yield flush()
+                yield flush()
+                if gzipper:
+                    yield gzipper.flush()
+
+            filename = 'database.csv.gz' if compress else 'database.csv'
+            return flask.Response(generate(), mimetype='application/gzip' if compress else 'text/csv',
+                                  headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
 
         @app.callback(
-            [Output('my-date-picker-range', 'min_date_allowed'),
-            Output('my-date-picker-range', 'start_date')],
-            Input('cache', 'data'))
-        def update_output(cache):
-            minDate = self.db.get_min_of('date')
-            return minDate, minDate
-
-        @app.callback(
-            Output('count-date', 'figure'),
-            [Input('cache', 'data'),
-            Input('timeperiod-dropdown', 'value'),
+            [Output('count-date', 'figure'), Output('count-date-version', 'data')],
+            [Input('timeperiod-dropdown', 'value'),
             Input('my-date-picker-range', 'start_date'),
-            Input('my-date-picker-range', 'end_date')])
-        def count_per_freq(cache, timeperiod, start, end):
-            freq_calc = { 'Day': 'date',
-                          'Week': 'date(date, "weekday 0", "-6 days")',
-                          'Month': 'strftime("%Y-%m-01", date)',
-                          'Year': 'strftime("%Y-01-01", date)' }
+            Input('my-date-picker-range', 'end_date'),
+            Input('chart-tabs', 'value')],
+            State('count-date-version', 'data'))
+        @self.lazy_figure('tab1')
+        @self.cached_figure(scope=lambda timeperiod, start, end: ('date BETWEEN ? AND ?', [start, end]) if start and end else None)
+        def count_per_freq(timeperiod, start, end):
             ticks = { 'Day': '%d %b <br>%Y', 'Week': 'Week %V <br>%Y', 'Month': '%b <br>%Y', 'Year': '%Y' }
 
-            query_type = '''SELECT {} AS freq, type, COUNT(id) FROM {}
-                WHERE "{}" <= date and date <= "{}"
-                GROUP BY freq, type ORDER BY freq;
-            '''.format(freq_calc[timeperiod], '{}', start, end)
-            dfCoundFreqType = pd.DataFrame(self.db.custom_query(query_type), columns=[timeperiod, 'Type', 'Count'])
-            
-            query_all = '''SELECT {} AS freq, COUNT(id) FROM {}
-                WHERE "{}" <= date and date <= "{}"
-                GROUP BY freq ORDER BY freq;
-            '''.format(freq_calc[timeperiod], '{}', start, end)
-            dfCoundFreqAll = pd.DataFrame(self.db.custom_query(query_all), columns=[timeperiod, 'Count'])
+            # buckets come from the maintained day/week/month/year rollups,
+            # the 'All' total per bucket is a window over the same groups instead of a second query
+            dfCountFreq = pd.DataFrame(self.db.count_per_period(timeperiod, start, end), columns=[timeperiod, 'Type', 'Count', 'All'])
+            dfCoundFreqType = dfCountFreq[[timeperiod, 'Type', 'Count']]
+            dfCoundFreqAll = dfCountFreq.drop_duplicates(timeperiod)[[timeperiod, 'All']].rename(columns={'All': 'Count'})
 
             lineDateType = px.line(dfCoundFreqType, x=timeperiod, y='Count', color='Type', category_orders = {'Type': ['Car', 'Motorbike']})
             lineDateType.add_scatter(x=dfCoundFreqAll[timeperiod], y=dfCoundFreqAll['Count'], line_color='black', name='All')
@@ -757,11 +1137,30 @@ class Carly:
             return lineDateType
 
         @app.callback(
-            Output('count-rangeslider', 'figure'),
-            Input('cache', 'data'))
-        def count_rangeslider(cache):
-            tempdfAll = pd.DataFrame(self.db.count_field('date'), columns=('Date', 'Count'))
+            [Output('count-rangeslider', 'figure'), Output('count-rangeslider-version', 'data')],
+            [Input('count-rangeslider', 'relayoutData'),
+            Input('chart-tabs', 'value')],
+            State('count-rangeslider-version', 'data'))
+        @self.lazy_figure('tab2')
+        @self.zoomed_figure
+        @self.cached_figure()
+        def count_rangeslider(window):
+            # the whole series is downsampled to series_max_points, the zoomed window gets as many again,
+            # so the payload stays constant and a window with fewer days than that is exact
+            daily = [row for row in self.db.count_field('date') if row[0] is not None]
+            dates = np.array([d for d, _ in daily], dtype='datetime64[D]')
+            counts = np.array([c for _, c in daily], dtype=np.int64)
+            keep = self.downsample(dates.astype(np.int64), counts, self.series_max_points)
+            if window:
+                # one day past each side of the window so the line runs to its edges
+                low = max(np.searchsorted(dates, np.datetime64(window[0], 'D'), side='left') - 1, 0)
+                high = min(np.searchsorted(dates, np.datetime64(window[1], 'D'), side='right') + 1, len(dates))
+                zoomed = low + self.downsample(dates[low:high].astype(np.int64), counts[low:high], self.series_max_points)
+                keep = np.union1d(keep[(keep < low) | (keep >= high)], zoomed)
+            tempdfAll = pd.DataFrame({'Date': dates[keep], 'Count': counts[keep]})
             lineRangeSlider = px.line(tempdfAll, x='Date', y='Count')
+            # keeps the user's zoom when the figure is replaced
+            lineRangeSlider.update_layout(uirevision='count-rangeslider')
             lineRangeSlider.update_xaxes(
                 rangeslider_visible=True,
                 rangeselector=dict(
@@ -785,43 +1184,59 @@ class Carly:
             return lineRangeSlider
 
         @app.callback(
-            Output('count-typefuel', 'figure'),
-            Input('cache', 'data'))
-        def count_per_typefuel(cache):
-            dfCountTypeFuel = pd.DataFrame(self.db.count_field('type, fuel'), columns=('Type', 'Fuel', 'Count'))
+            [Output('count-typefuel', 'figure'), Output('count-typefuel-version', 'data')],
+            Input('chart-tabs', 'value'),
+            State('count-typefuel-version', 'data'))
+        @self.lazy_figure('tab3')
+        @self.cached_figure()
+        def count_per_typefuel():
+            fuel = self.db.aggregates()['fuel']
+            dfCountType = pd.DataFrame([(t, c) for t, c, _, _, _ in fuel['types']], columns=('Type', 'Count'))
+            dfCountTypeFuel = pd.DataFrame([(t, f, c) for f, t, c, _, _, _ in fuel['by_type']], columns=('Type', 'Fuel', 'Count'))
             dfCountCarFuel = dfCountTypeFuel.loc[dfCountTypeFuel['Type']=='Car']
             dfCountMotoFuel = dfCountTypeFuel.loc[dfCountTypeFuel['Type']=='Motorbike']
             
             pies = sp.make_subplots(1,3, specs=[[{'type':'domain'}, {'type':'domain'}, {'type':'domain'}]],
                                     subplot_titles=['Count Vehicles', 'Car Fuel', 'Motorbike Fuel'])
-            pies.add_trace(go.Pie(labels=dfCountTypeFuel['Type'], values=dfCountTypeFuel['Count'], text=dfCountTypeFuel['Type'], scalegroup='one', name=''), 1, 1)
+            pies.add_trace(go.Pie(labels=dfCountType['Type'], values=dfCountType['Count'], text=dfCountType['Type'], scalegroup='one', name=''), 1, 1)
             pies.add_trace(go.Pie(labels=dfCountCarFuel['Fuel'], values=dfCountCarFuel['Count'], text=dfCountCarFuel['Fuel'], scalegroup='one', name=''), 1, 2)
             pies.add_trace(go.Pie(labels=dfCountMotoFuel['Fuel'], values=dfCountMotoFuel['Count'], text=dfCountMotoFuel['Fuel'], scalegroup='one', name=''), 1, 3)
 
             return pies
 
         @app.callback(
-            Output('km-per-manyear', 'figure'),
-            [Input('cache', 'data'),
-            Input('type-radios1', 'value')])
-        def km_per_manyear(cache, selected_type):
-            filtered_db = self.db.select_type(selected_type) if selected_type != 'All' else self.db.get_all()
-            filtered_df = pd.DataFrame(filtered_db, columns=self.columns)
+            [Output('km-per-manyear', 'figure'), Output('km-per-manyear-version', 'data')],
+            [Input('type-radios1', 'value'),
+            Input('chart-tabs', 'value')],
+            State('km-per-manyear-version', 'data'))
+        @self.lazy_figure('tab4')
+        @self.cached_figure(scope=lambda selected_type: self.type_scope(selected_type))
+        def km_per_manyear(selected_type):
+            # above scatter_max_points the browser gets a per brand sample drawn with WebGL instead of one SVG marker per vehicle
+            filtered_df, total = self.snapshot.sample(('brand', 'model', 'manufacture_year', 'kilometers', 'price'), self.scatter_max_points,
+                                                      'brand', selected_type if selected_type != 'All' else None)
+            filtered_df.columns = ('Brand', 'Model', 'Manufacture Year', 'Kilometers', 'Price')
+            large = total > self.scatter_max_points
             
-            scatterKmPerManYear = px.scatter(filtered_df, x='Manufacture Year', y='Kilometers', size='Price', color='Brand', custom_data=('Brand', 'Model', 'Price'))
+            scatterKmPerManYear = px.scatter(filtered_df, x='Manufacture Year', y='Kilometers', size='Price', color='Brand', custom_data=('Brand', 'Model', 'Price'),
+                                             render_mode='webgl' if large else 'svg')
             scatterKmPerManYear.update_traces(hovertemplate='<b>%{customdata[0]} %{customdata[1]}</b> <br><br>Manufacture Year=%{x}<br>Kilometers=%{y}<br>Price=%{customdata[2]}<extra></extra>')
+            if large:
+                scatterKmPerManYear.update_layout(title_text='Sample of {} of {} vehicles'.format(len(filtered_df), total), title_font_size=12)
             return scatterKmPerManYear
 
         @app.callback(
-            Output('price-range-pie', 'figure'),
-            Input('cache', 'data'))
-        def count_per_pricerange(cache):
-            query = 'SELECT FLOOR(price / 10000) as floor, COUNT(id) FROM {} GROUP BY floor'
-
-            range_list = [("[{}0k, {}0k)".format(i, i+1), c) for i, c in self.db.custom_query(query)]
-            if '[00k' in range_list[0][0]:
-                range_list[0] = ('[0, 10k)', range_list[0][1])
-            dfPriceRange = pd.DataFrame(range_list, columns=['Price Range', 'Count'])
+            [Output('price-range-pie', 'figure'), Output('price-range-pie-version', 'data')],
+            Input('chart-tabs', 'value'),
+            State('price-range-pie-version', 'data'))
+        @self.lazy_figure('tab5')
+        @self.cached_figure()
+        def count_per_pricerange():
+            # a pie stays readable up to about ten slices, empty bins are left out
+            bins = collections.Counter()
+            for low, high, _, count in self.db.histogram('price', bins=10):
+                bins[self.bin_label(low, high)] += count
+            dfPriceRange = pd.DataFrame([(b, c) for b, c in bins.items() if c], columns=['Price Range', 'Count'])
             
             piePriceRange = px.pie(dfPriceRange, values='Count', names='Price Range', color='Price Range')
             piePriceRange.update_traces(sort=False, textinfo='percent+label', hovertemplate='Price Range=%{label}<br>Count=%{value}</br>Percent=%{percent}')
@@ -831,16 +1246,17 @@ class Carly:
             return piePriceRange
 
         @app.callback(
-            Output('avg-price-per-type-status', 'figure'),
-            Input('cache', 'data'))
-        def avg_price_per_typestatus(cache):
-            query_type = 'SELECT type, status, AVG(price) FROM {} GROUP BY type, status'
-            query_all = 'SELECT status, AVG(price) FROM {} GROUP BY status'
-
-            tempdfTypeMean = pd.DataFrame(self.db.custom_query(query_type), columns=('Type', 'Status', 'Average Price'))
-            tempdfAllMean = pd.DataFrame(self.db.custom_query(query_all), columns=('Status', 'Average Price'))
-            tempdfAllMean.insert(0, 'Type', ['All', 'All'], True)
-            dfAvgPricePerTypeStatus = tempdfTypeMean.append(tempdfAllMean, ignore_index=True)
+            [Output('avg-price-per-type-status', 'figure'), Output('avg-price-per-type-status-version', 'data')],
+            Input('chart-tabs', 'value'),
+            State('avg-price-per-type-status-version', 'data'))
+        @self.lazy_figure('tab6')
+        @self.cached_figure()
+        def avg_price_per_typestatus():
+            status = self.db.aggregates()['status']
+            type_mean = [(t, s, price_sum / price_count) for s, t, _, price_count, price_sum, _ in status['by_type'] if price_count]
+            all_mean = [('All', s, price_sum / price_count) for s, _, price_count, price_sum, _ in status['all'] if price_count]
+
+            dfAvgPricePerTypeStatus = pd.DataFrame(sorted(type_mean) + all_mean, columns=('Type', 'Status', 'Average Price'))
             barAvgPricePerTypeStatus = px.bar(dfAvgPricePerTypeStatus, x='Type', y='Average Price', color='Status', barmode='group', text='Status')
             barAvgPricePerTypeStatus.update_traces(texttemplate='%{text}<br>%{value:.2s}€', textfont_size=12, textangle=0, textposition='inside', cliponaxis=False)
             barAvgPricePerTypeStatus.update_layout(showlegend=False)
@@ -848,15 +1264,21 @@ class Carly:
             return barAvgPricePerTypeStatus
 
         @app.callback(
-            Output('avg-price-per-brand', 'figure'),
-            [Input('cache', 'data'),
-            Input('type-radios2', 'value')])
-        def avg_price_per_brand(cache, selected_type):
-            query = 'SELECT brand, AVG(price) FROM {} GROUP BY brand'
-            if selected_type != 'All':
-                query = query.format('{} WHERE type = "%s"' % (selected_type))
-
-            dfAvgPricePerBrand = pd.DataFrame(self.db.custom_query(query), columns=('Brand', 'Average Price'))
+            [Output('avg-price-per-brand', 'figure'), Output('avg-price-per-brand-version', 'data')],
+            [Input('type-radios2', 'value'),
+            Input('chart-tabs', 'value')],
+            State('avg-price-per-brand-version', 'data'))
+        @self.lazy_figure('tab7')
+        @self.cached_figure(scope=lambda selected_type: self.type_scope(selected_type))
+        def avg_price_per_brand(selected_type):
+            brand = self.db.aggregates()['brand']
+            if selected_type == 'All':
+                brands = brand['all']
+            else:
+                brands = [(b, *measures) for b, t, *measures in brand['by_type'] if t == selected_type]
+
+            dfAvgPricePerBrand = pd.DataFrame([(b, price_sum / price_count) for b, _, price_count, price_sum, _ in brands if price_count],
+                                              columns=('Brand', 'Average Price'))
             barAvgPrice = px.bar(dfAvgPricePerBrand, x='Brand', y='Average Price', color='Brand', text_auto='.2s')
             barAvgPrice.update_traces(textfont_size=12, textangle=0, textposition='outside', cliponaxis=False)
             barAvgPrice.update_layout(hovermode=False)
@@ -864,12 +1286,15 @@ class Carly:
             return barAvgPrice
 
         @app.callback(
-            Output('max-engine-per-brand', 'figure'),
-            Input('cache', 'data'))
-        def max_engine_per_brand(cache):
-            query = 'SELECT brand, MAX(engine) FROM {} GROUP BY brand'
+            [Output('max-engine-per-brand', 'figure'), Output('max-engine-per-brand-version', 'data')],
+            Input('chart-tabs', 'value'),
+            State('max-engine-per-brand-version', 'data'))
+        @self.lazy_figure('tab8')
+        @self.cached_figure()
+        def max_engine_per_brand():
+            brands = self.db.aggregates()['brand']['all']
             
-            dfMaxEnginePerBrand = pd.DataFrame(self.db.custom_query(query), columns=('Brand', 'Maximum Engine'))
+            dfMaxEnginePerBrand = pd.DataFrame([(b, engine_max) for b, _, _, _, engine_max in brands], columns=('Brand', 'Maximum Engine'))
             barMaxEnginePerBrand = px.bar(dfMaxEnginePerBrand, x='Brand', y='Maximum Engine', color='Brand')
             barMaxEnginePerBrand.update_traces(texttemplate='%{y}cc', textfont_size=12, textangle=0, textposition='outside', cliponaxis=False)
             barMaxEnginePerBrand.update_layout(hovermode=False)
@@ -877,9 +1302,12 @@ class Carly:
             return barMaxEnginePerBrand
 
         @app.callback(
-            Output('count-color', 'figure'),
-            Input('cache', 'data'))
-        def count_per_color(cache):
+            [Output('count-color', 'figure'), Output('count-color-version', 'data')],
+            Input('chart-tabs', 'value'),
+            State('count-color-version', 'data'))
+        @self.lazy_figure('tab9')
+        @self.cached_figure()
+        def count_per_color():
             Colormap = {
                 'black':'black',
                 'brown':'brown',
@@ -894,7 +1322,7 @@ class Carly:
                 'yellow':'gold',  
             }
 
-            dfCountColors = pd.DataFrame(self.db.count_field('color'), columns=('Color', 'Count'))
+            dfCountColors = pd.DataFrame([(c, count) for c, count, _, _, _ in self.db.aggregates()['color']['all']], columns=('Color', 'Count'))
             barColor = px.bar(dfCountColors, x='Color', y='Count', color='Color', text='Count', color_discrete_map=Colormap)
             barColor.update_traces(textfont_size=12, textangle=0, textposition='outside', cliponaxis=False)
             barColor.update_layout(hovermode=False)
@@ -916,30 +1344,36 @@ class Carly:
             return options, options[0]['value']
 
         @app.callback(
-            Output('count-per-typefield', 'figure'),
-            [Input('cache', 'data'),
-            Input('type-radios3', 'value'),
-            Input('field-dropdown', 'value')])
-        def count_per_field(cache, selected_type, selected_field):
+            [Output('count-per-typefield', 'figure'), Output('count-per-typefield-version', 'data')],
+            [Input('type-radios3', 'value'),
+            Input('field-dropdown', 'value'),
+            Input('chart-tabs', 'value')],
+            State('count-per-typefield-version', 'data'))
+        @self.lazy_figure('tab10')
+        @self.cached_figure(scope=lambda selected_type, selected_field: self.type_scope(selected_type))
+        def count_per_field(selected_type, selected_field):
             fields_dict = {'ID': 'id', 'Type': 'type', 'Brand': 'brand', 'Model': 'model', 'Color': 'color',
                            'Fuel': 'fuel', 'Engine': 'engine', 'HP': 'hp', 'Doors': 'doors', 'Sunroof': 'sunroof',
                            'Cases': 'cases', 'Manufacture Year': 'manufacture_year', 'Status': 'status',
                            'Kilometers': 'kilometers', 'Price': 'price', 'Date Added': 'date'}
             
             field = fields_dict[selected_field]
-            if selected_type == 'All':
+            type = selected_type if selected_type != 'All' else None
+            colorfield = 'Type' if type is None else None
+            catorder = {'Type': ['Car', 'Motorbike']} if type is None else {}
+            if field in self.db.BINNED:
+                # continuous fields are binned server side, so the payload is bounded by the bin count
+                bins = [(self.bin_label(low, high), t, count) for low, high, t, count in self.db.histogram(field, type, self.histogram_bins)]
+                dfCountPerField = pd.DataFrame(bins, columns=(selected_field, 'Type', 'Count'))
+            elif type is None:
                 dfCountPerField = pd.DataFrame(self.db.count_field('{}, type'.format(field)), columns=(selected_field, 'Type', 'Count'))
-                colorfield = 'Type'
-                catorder = {'Type': ['Car', 'Motorbike']}
             else:
                 dfCountPerField = pd.DataFrame(self.db.count_field(field, selected_type), columns=(selected_field, 'Count'))
-                colorfield = None
-                catorder = {}
 
             fig = px.bar(dfCountPerField, x=selected_field, y='Count', color=colorfield, category_orders=catorder)
-            if selected_field in {'Engine', 'Kilometers', 'Price'}:
-                # make bad plots into scatter
-                fig = px.scatter(dfCountPerField, x=selected_field, y='Count', color=colorfield, category_orders=catorder)
+            if field in self.db.BINNED:
+                fig.update_xaxes(type='category')
+                fig.update_layout(bargap=0.05)
             elif selected_field in {'Model'}:
                 fig.update_yaxes(dtick=1)
             elif selected_field in {'Doors', 'Cases'}:
@@ -947,25 +1381,690 @@ class Carly:
             
             return fig
 
+class Metrics:
+    # latency histogram, calls, rows and payload bytes per dash callback and per sql statement,
+    # rendered in the Prometheus text format; each worker process keeps its own
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    # (kind, label): metric name prefix, label name
+    KINDS = {'callback': ('carly_callback', 'callback'), 'sql': ('carly_sql', 'statement')}
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.series = {}  # (kind, name) -> [count per bucket (last is +Inf), count, seconds, rows, bytes]
+        # rows fetched by the current thread since begin(), to attribute sql rows to the callback running it
+        self.local = threading.local()
+
+    def observe(self, kind, name, seconds, rows=0, size=0) -> None:
+        with self.lock:
+            series = self.series.get((kind, name))
+            if series is None:
+                series = self.series[(kind, name)] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0, 0, 0]
+            series[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            series[1] += 1
+            series[2] += seconds
+            series[3] += rows
+            series[4] += size
+        if kind == 'sql' and getattr(self.local, 'rows', None) is not None:
+            self.local.rows += rows
+
+    def begin(self) -> None:
+        self.local.rows = 0
+
+    def end(self) -> int:
+        rows, self.local.rows = getattr(self.local, 'rows', None) or 0, None
+        return rows
+
+    @staticmethod
+    def statement(sql) -> str:
+        # one series per query shape: literals replaced by ?, whitespace collapsed
+        sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+        sql = re.sub(r'(?<![\w"])-?\d+(?:\.\d+)?\b', '?', sql)
+        return ' '.join(sql.split())[:300]
+
+    def render(self) -> str:
+        escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        with self.lock:
+            series = sorted((k, [list(v[0])] + v[1:]) for k, v in self.series.items())
+        lines = []
+        for kind, (prefix, label) in self.KINDS.items():
+            rows = [(name, values) for (k, name), values in series if k == kind]
+            lines += ['# HELP {}_seconds Latency of each {}.'.format(prefix, label), '# TYPE {}_seconds histogram'.format(prefix)]
+            for name, (buckets, count, seconds, _, _) in rows:
+                labels = '{}="{}"'.format(label, escape(name))
+                for le, cumulative in zip(self.BUCKETS + ('+Inf',), itertools.accumulate(buckets)):
+                    lines.append('{}_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, le, cumulative))
+                lines.append('{}_seconds_sum{{{}}} {}'.format(prefix, labels, seconds))
+                lines.append('{}_seconds_count{{{}}} {}'.format(prefix, labels, count))
+            lines += ['# HELP {}_rows_total Rows returned by sql.'.format(prefix), '# TYPE {}_rows_total counter'.format(prefix)]
+            lines += ['{}_rows_total{{{}="{}"}} {}'.format(prefix, label, escape(name), values[3]) for name, values in rows]
+            if kind == 'callback':
+                lines += ['# HELP {}_response_bytes_total Response payload bytes.'.format(prefix),
+                          '# TYPE {}_response_bytes_total counter'.format(prefix)]
+                lines += ['{}_response_bytes_total{{{}="{}"}} {}'.format(prefix, label, escape(name), values[4]) for name, values in rows]
+        return '\n'.join(lines) + '\n'
+
+class QueryAuditor:
+    # runs EXPLAIN QUERY PLAN once per statement shape the app issues, and keeps the plans
+    # that scan the whole vehicles table or build a temporary b-tree to group or sort its rows
+    # (sorts of the summary and change log tables are bounded by their groups, so they aren't flagged)
+    SCAN = re.compile(r'\bSCAN (TABLE )?vehicles\b')
+    SORT = re.compile(r'USE TEMP B-TREE FOR (GROUP BY|ORDER BY|DISTINCT)')
+    READS = re.compile(r'\b(SCAN|SEARCH) (TABLE )?vehicles\b')
+    # a min/max aggregate reports a bare SEARCH both for the single row read of MAX(id) and for a full scan under
+    # a WHERE that no index covers, only the sql tells them apart
+    MINMAX = re.compile(r'\bSEARCH (TABLE )?vehicles$')
+    AUDITED = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE')
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.flagged = {}  # statement shape -> plan lines
+
+    def check(self, con, sql, params=()) -> None:
+        statement = Metrics.statement(sql)
+        with self.lock:
+            if statement in self.seen:
+                return
+            self.seen.add(statement)
+        words = sql.split(None, 1)
+        if not words or words[0].upper() not in self.AUDITED:
+            return
+        try:
+            # a plain cursor, so the plan query itself is neither audited nor timed
+            plan = [row[-1] for row in sqlite3.Cursor(con).execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        except sqlite3.Error:
+            return
+        if any(self.SCAN.search(line) for line in plan) or (
+                any(self.READS.search(line) for line in plan) and any(self.SORT.search(line) for line in plan)) or (
+                ' WHERE ' in ' {} '.format(sql.upper()) and any(self.MINMAX.search(line) for line in plan)):
+            with self.lock:
+                self.flagged[statement] = plan
+
+    def check_triggers(self, con, table='vehicles') -> None:
+        # trigger bodies never go through a cursor: their statements are explained here,
+        # with the OLD and NEW columns as parameters
+        triggers = sqlite3.Cursor(con).execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?;", (table,))
+        for sql, in triggers.fetchall():
+            body = sql[sql.upper().index(' BEGIN ') + 7:sql.upper().rindex('END')]
+            for statement in body.split(';'):
+                statement = re.sub(r'\b(?:OLD|NEW)\.\w+', '?', statement).strip()
+                if statement:
+                    self.check(con, statement + ';', (None,) * statement.count('?'))
+
+    def report(self) -> str:
+        with self.lock:
+            flagged = sorted(self.flagged.items())
+            audited = len(self.seen)
+        lines = ['{} of {} statements scan vehicles or sort with a temp b-tree'.format(len(flagged), audited)]
+        for statement, plan in flagged:
+            lines += ['', statement] + ['    ' + line for line in plan]
+        return '\n'.join(lines) + '\n'
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # times each statement from execute until its rows are fetched, then reports it to the connection's metrics
+    def execute(self, sql, *args):
+        if self.connection.auditor is not None:
+            self.connection.auditor.check(self.connection, sql, *args)
+        return self.run(super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.run(super().executemany, sql, *args)
+
+    def run(self, execute, sql, *args):
+        self.finish()
+        start = time.perf_counter()
+        try:
+            return execute(sql, *args)
+        finally:
+            self.pending = [sql, time.perf_counter() - start, 0]
+            if self.description is None:
+                # no rows to fetch
+                self.finish()
+
+    def fetched(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        pending = getattr(self, 'pending', None)
+        if pending:
+            pending[1] += time.perf_counter() - start
+            pending[2] += len(rows) if isinstance(rows, list) else rows is not None
+        return rows
+
+    def fetchone(self):
+        row = self.fetched(super().fetchone)
+        if row is None:
+            self.finish()
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.fetched(super().fetchmany, size or self.arraysize)
+        if not rows:
+            self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self.fetched(super().fetchall)
+        self.finish()
+        return rows
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        # statements whose rows were not all fetched
+        self.finish()
+
+    def finish(self):
+        pending, self.pending = getattr(self, 'pending', None), None
+        if pending and self.connection.metrics is not None:
+            self.connection.metrics.observe('sql', Metrics.statement(pending[0]), pending[1], rows=pending[2])
+
+class InstrumentedConnection(sqlite3.Connection):
+    metrics = None
+    auditor = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+class ConnectionPool:
+    # tuned once per connection, override any of them with the pragmas argument
+    PRAGMAS = {
+        'journal_mode': 'WAL',      # readers don't block the writer
+        'synchronous': 'NORMAL',    # safe with WAL, one fsync per checkpoint instead of per commit
+        'cache_size': -64000,       # negative means KiB (64MB page cache)
+        'mmap_size': 268435456,     # 256MB memory mapped reads
+        'busy_timeout': 5000,       # ms to wait for a lock before raising "database is locked"
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, db_file, size=8, pragmas=None, timeout=30, metrics=None, auditor=None) -> None:
+        self.db_file = db_file
+        # with metrics, every statement run on the pooled connections is timed,
+        # with an auditor, the query plan of every statement shape is checked
+        self.metrics = metrics
+        self.auditor = auditor
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(self.PRAGMAS, **(pragmas or {}))
+
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self) -> sqlite3.Connection:
+        # check_same_thread is off because a connection moves between the worker threads,
+        # the pool guarantees only one thread uses it at a time
+        if self.metrics is not None or self.auditor is not None:
+            con = sqlite3.connect(self.db_file, check_same_thread=False, factory=InstrumentedConnection)
+            con.metrics = self.metrics
+            con.auditor = self.auditor
+        else:
+            con = sqlite3.connect(self.db_file, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            if not re.fullmatch(r'\w+', name) or not re.fullmatch(r'[\w-]+', str(value)):
+                raise ValueError('Invalid pragma: {} = {}'.format(name, value))
+            con.execute('PRAGMA {} = {};'.format(name, value))
+        return con
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self.open()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        # all connections are busy: wait for one to be released
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('connection pool exhausted') from None
+
+    def release(self, con) -> None:
+        if con.in_transaction:
+            con.rollback()
+        self.idle.put_nowait(con)
+
+    @contextlib.contextmanager
+    def connection(self):
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release(con)
+
+    def close(self) -> None:
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
+            with self.lock:
+                self.opened -= 1
+
+class QueryCache:
+    # bounded LRU cache for query results and figures
+    # keys must include the data version so that writes invalidate them
+    # with maxbytes, entries are also evicted once their total sizeof(value) exceeds it
+    def __init__(self, maxsize=256, maxbytes=None, sizeof=None) -> None:
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        # computed outside the lock, two threads may race on the same key but both get a correct value
+        value = compute()
+        size = self.sizeof(value)
+        with self.lock:
+            self.bytes += size - self.sizes.get(key, 0)
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes and len(self.entries) > 1):
+                evicted, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(evicted)
+                self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.entries), 'maxsize': self.maxsize, 'bytes': self.bytes, 'maxbytes': self.maxbytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class VehicleSnapshot:
+    # in-memory columnar copy of the vehicles table for vectorized analytics, read by the per vehicle
+    # kilometers per manufacture year scatter; the other charts aggregate the summary table instead
+    # text columns are stored as integer codes into a list of categories (-1 is NULL),
+    # numbers as float64 (NaN is NULL), dates as datetime64[D] (NaT is NULL)
+    CATEGORIES = ('type', 'brand', 'model', 'color', 'fuel', 'sunroof', 'status')
+    NUMBERS = ('engine', 'hp', 'doors', 'cases', 'manufacture_year', 'kilometers', 'price')
+
+    def __init__(self, db) -> None:
+        self.db = db
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self) -> None:
+        with self.lock:
+            self.categories = {c: [] for c in self.CATEGORIES}
+            self.category_codes = {c: {} for c in self.CATEGORIES}
+            self.arrays = {}
+            self.size = 0
+            self.capacity = 0
+            self.rows = {}  # id -> row index
+            self.deleted = 0
+            self.version = 0
+            for version, rows in self.db.iter_snapshot():
+                self.version = version
+                self.append(rows)
+
+    def encode(self, column, values) -> np.ndarray:
+        # vectorized: factorize the chunk, then map its few uniques to the global codes
+        local_codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        categories, codes = self.categories[column], self.category_codes[column]
+        mapping = np.empty(len(uniques), dtype=np.int32)
+        for i, value in enumerate(uniques):
+            if value not in codes:
+                codes[value] = len(categories)
+                categories.append(value)
+            mapping[i] = codes[value]
+        return np.where(local_codes >= 0, mapping[local_codes] if len(mapping) else -1, -1).astype(np.int32)
+
+    def append(self, rows) -> None:
+        if not rows:
+            return
+        columns = dict(zip(self.db.columns, zip(*rows)))
+        new = {
+            'id': np.array(columns['id'], dtype=np.int64),
+            'date': np.array(columns['date'], dtype='datetime64[D]'),
+            'alive': np.ones(len(rows), dtype=bool),
+        }
+        for column in self.CATEGORIES:
+            new[column] = self.encode(column, columns[column])
+        for column in self.NUMBERS:
+            new[column] = np.array(columns[column], dtype=np.float64)  # None becomes NaN
+
+        if self.size + len(rows) > self.capacity:
+            # amortized growth, like a list
+            self.capacity = max(2 * self.capacity, self.size + len(rows), 1024)
+            for column, values in new.items():
+                grown = np.empty(self.capacity, dtype=values.dtype)
+                if column in self.arrays:
+                    grown[:self.size] = self.arrays[column][:self.size]
+                self.arrays[column] = grown
+        for column, values in new.items():
+            self.arrays[column][self.size:self.size + len(rows)] = values
+        self.rows.update(zip(columns['id'], range(self.size, self.size + len(rows))))
+        self.size += len(rows)
+
+    def remove(self, ids) -> None:
+        for vehicle_id in ids:
+            row = self.rows.pop(vehicle_id, None)
+            if row is not None:
+                self.arrays['alive'][row] = False
+                self.deleted += 1
+        if self.deleted > 1024 and self.deleted > self.size // 4:
+            self.compact()
+
+    def compact(self) -> None:
+        # drops the rows of deleted vehicles
+        alive = self.arrays['alive'][:self.size]
+        for column in list(self.arrays):
+            self.arrays[column] = self.arrays[column][:self.size][alive].copy()
+        self.size = self.capacity = int(alive.sum())
+        self.rows = dict(zip(self.arrays['id'].tolist(), range(self.size)))
+        self.deleted = 0
+
+    def refresh(self) -> None:
+        # applies the writes logged since the snapshot was taken, from any process
+        with self.lock:
+            horizon, changes = self.db.changes_since(self.version)
+            if self.version < horizon:
+                # too far behind, the log was pruned
+                self.load()
+                return
+            inserts = []
+            for version, op, *row in changes:
+                if op == 'delete':
+                    self.append(inserts)
+                    inserts = []
+                    self.remove([row[0]])
+                else:
+                    self.remove([row[0]])
+                    inserts.append(tuple(row))
+                self.version = version
+            self.append(inserts)
+
+    def mask(self, type=None) -> np.ndarray:
+        mask = self.arrays['alive'][:self.size].copy() if self.size else np.zeros(0, dtype=bool)
+        if type is not None:
+            code = self.category_codes['type'].get(type, -2)
+            mask &= self.arrays['type'][:self.size] == code
+        return mask
+
+    def keys(self, column, mask) -> tuple:
+        # (codes, number of codes, code -> label) of a column for the selected rows, NULL is -1
+        values = self.arrays[column][:self.size][mask]
+        if column in self.CATEGORIES:
+            return values, len(self.categories[column]), self.categories[column].__getitem__
+        if column == 'date':
+            # days since the first date, no sorting needed
+            days = values.astype(np.int64)
+            null = np.isnat(values)
+            first = int(days[~null].min()) if (~null).any() else 0
+            codes = np.where(null, -1, days - first)
+            return codes, int(codes.max()) + 1 if len(codes) else 0, lambda code: str(np.datetime64(first + code, 'D'))
+        null = np.isnan(values)
+        labels, inverse = np.unique(values[~null], return_inverse=True)
+        codes = np.full(len(values), -1, dtype=np.int64)
+        codes[~null] = inverse
+        return codes, len(labels), lambda code: int(labels[code]) if labels[code].is_integer() else float(labels[code])
+
+    def aggregate(self, by, value=None, how='count', type=None) -> list:
+        # group by one or more columns with bincount, returns [(key, ..., result)] for non-empty groups
+        self.refresh()
+        with self.lock:
+            if not self.size:
+                return []
+            mask = self.mask(type)
+            group = np.zeros(int(mask.sum()), dtype=np.int64)
+            sizes = []
+            labels = []
+            for column in by:
+                codes, size, label = self.keys(column, mask)
+                # NULL (-1) gets its own slot at the end
+                codes = np.where(codes < 0, size, codes)
+                group = group * (size + 1) + codes
+                sizes.append(size + 1)
+                labels.append(lambda code, size=size, label=label: None if code == size else label(code))
+            values = self.arrays[value][:self.size][mask] if value else None
+
+        groups = int(np.prod(sizes)) if sizes else 1
+        if value is not None:
+            valid = ~np.isnan(values)
+            group, values = group[valid], values[valid]
+        counts = np.bincount(group, minlength=groups)
+        if how == 'count':
+            result = counts
+        elif how == 'sum':
+            result = np.bincount(group, weights=values, minlength=groups)
+        elif how == 'mean':
+            result = np.bincount(group, weights=values, minlength=groups) / np.maximum(counts, 1)
+        elif how == 'max':
+            result = np.full(groups, -np.inf)
+            np.maximum.at(result, group, values)
+        else:
+            raise ValueError('Unknown aggregate: {}'.format(how))
+
+        found = np.flatnonzero(counts)
+        columns = []
+        for i, codes in enumerate(np.unravel_index(found, sizes) if sizes else ()):
+            # one label lookup per distinct code, not per group
+            codes = codes.tolist()
+            names = {code: labels[i](code) for code in set(codes)}
+            columns.append([names[code] for code in codes])
+        columns.append(result[found].tolist())
+        return list(zip(*columns))
+
+    def frame(self, columns, type=None, rows=None) -> pd.DataFrame:
+        # selected columns of the live rows (or of the given row indexes), text columns as pandas categoricals
+        self.refresh()
+        with self.lock:
+            if not self.size:
+                return pd.DataFrame(columns=columns)
+            rows = self.mask(type) if rows is None else rows
+            data = {}
+            for column in columns:
+                values = self.arrays[column][:self.size][rows]
+                if column in self.CATEGORIES:
+                    values = pd.Categorical.from_codes(values, categories=pd.Index(self.categories[column], dtype=object))
+                data[column] = values
+        return pd.DataFrame(data)
+
+    def sample(self, columns, size, by, type=None, seed=0) -> tuple:
+        # (frame, live rows) of a stratified sample of about `size` live rows:
+        # every `by` group keeps its share of the rows, and at least one, so small groups don't vanish
+        self.refresh()
+        with self.lock:
+            if not self.size:
+                return pd.DataFrame(columns=columns), 0
+            rows = np.flatnonzero(self.mask(type))
+            if len(rows) <= size:
+                return self.frame(columns, rows=rows), len(rows)
+            groups = self.arrays[by][:self.size][rows] + 1  # NULL (-1) is group 0
+            counts = np.bincount(groups)
+            quota = np.maximum(1, counts * size // len(rows))
+            # random order inside each group, the first `quota` rows of a group are kept
+            order = np.lexsort((np.random.default_rng(seed).random(len(rows)), groups))
+            starts = np.cumsum(counts) - counts
+            rank = np.arange(len(rows)) - starts[groups[order]]
+            keep = np.sort(order[rank < quota[groups[order]]])
+            return self.frame(columns, rows=rows[keep]), len(rows)
+
+    def memory_usage(self) -> dict:
+        # bytes per column, including the category labels, and of the id -> row index dict with its int keys and values
+        # (small ints are shared by the interpreter, so that one is slightly overcounted)
+        with self.lock:
+            usage = {column: values.nbytes for column, values in self.arrays.items()}
+            for column in self.CATEGORIES:
+                usage[column] = usage.get(column, 0) + sum(sys.getsizeof(c) for c in self.categories[column])
+            usage['ids'] = sys.getsizeof(self.rows) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.rows.items())
+        return usage
+
 class DataBase:
-    def __init__(self, input_file) -> None:
+    # schema migrations, applied in order and tracked with PRAGMA user_version
+    # never edit a released migration, append a new one instead
+    MIGRATIONS = [
+        # 1: secondary indexes for the chart, duplicate lookup and date range queries
+        [
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_type_brand_model ON vehicles (type, brand, model);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_date_type ON vehicles (date, type);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_brand_price ON vehicles (brand, price);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_brand_engine ON vehicles (brand, engine);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_type_fuel ON vehicles (type, fuel);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_type_status_price ON vehicles (type, status, price);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_color ON vehicles (color);',
+            'CREATE INDEX IF NOT EXISTS idx_vehicles_price ON vehicles (price);',
+            'ANALYZE vehicles;',
+        ],
+        # 2: data version bumped by every write to vehicles, used as cache key
+        [
+            'CREATE TABLE IF NOT EXISTS data_version (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL);',
+            'INSERT OR IGNORE INTO data_version VALUES (0, 0);',
+            'CREATE TRIGGER IF NOT EXISTS vehicles_version_insert AFTER INSERT ON vehicles BEGIN UPDATE data_version SET version = version + 1; END;',
+            'CREATE TRIGGER IF NOT EXISTS vehicles_version_update AFTER UPDATE ON vehicles BEGIN UPDATE data_version SET version = version + 1; END;',
+            'CREATE TRIGGER IF NOT EXISTS vehicles_version_delete AFTER DELETE ON vehicles BEGIN UPDATE data_version SET version = version + 1; END;',
+        ],
+        # 3: summary table per dimension and type, maintained by triggers
+        lambda db: db.summary_schema(('brand', 'model', 'color', 'fuel', 'engine', 'hp', 'doors', 'sunroof', 'cases',
+                                      'manufacture_year', 'status', 'kilometers', 'price', 'date', 'price_range')),
+        # 4: log of the rows touched by each write (old and new values), see scope_version
+        lambda db: db.change_log_schema(5000),
+        # 5: week, month and year rollups of the date added, next to the daily counts
+        lambda db: db.summary_schema(db.summary_dims_installed() + ('date_week', 'date_month', 'date_year')),
+        # 6: settings shared by every process, e.g. the key that signs the session cookies
+        [
+            'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);',
+            "INSERT OR IGNORE INTO settings VALUES ('secret_key', lower(hex(randomblob(32))));",
+        ],
+        # 7: engine_max only for ENGINE_MAX_DIMS, the delete of a group's max vehicle rescans it with an index seek
+        lambda db: ['CREATE INDEX IF NOT EXISTS idx_vehicles_brand_type_engine ON vehicles (brand, type, engine);']
+                   + db.summary_schema(db.summary_dims_installed()),
+        # 8: drops the price_range dimension, no chart reads it since the price pie is binned by DataBase.histogram
+        lambda db: db.summary_schema(tuple(dim for dim in db.summary_dims_installed() if dim != 'price_range')),
+        # 9: drops the indexes of migration 1 that served chart group-bys, the charts read the summary table since;
+        # brand and type filters of the table still seek (brand, type, engine) and (type, brand, model)
+        [
+            'DROP INDEX IF EXISTS idx_vehicles_brand_price;',
+            'DROP INDEX IF EXISTS idx_vehicles_brand_engine;',
+            'DROP INDEX IF EXISTS idx_vehicles_type_fuel;',
+            'DROP INDEX IF EXISTS idx_vehicles_type_status_price;',
+            'DROP INDEX IF EXISTS idx_vehicles_color;',
+        ],
+        # 10: price_count next to price_sum, average prices leave out the vehicles without a price
+        lambda db: db.summary_schema(db.summary_dims_installed()),
+    ]
+
+    # dimensions the summary table can hold, {row} is NEW, OLD or vehicles
+    SUMMARY_DIMS = {
+        'brand': '{row}.brand',
+        'model': '{row}.model',
+        'color': '{row}.color',
+        'fuel': '{row}.fuel',
+        'engine': '{row}.engine',
+        'hp': '{row}.hp',
+        'doors': '{row}.doors',
+        'sunroof': '{row}.sunroof',
+        'cases': '{row}.cases',
+        'manufacture_year': '{row}.manufacture_year',
+        'status': '{row}.status',
+        'kilometers': '{row}.kilometers',
+        'price': '{row}.price',
+        'date': '{row}.date',
+        # only installed by migration 3 and dropped by migration 8
+        'price_range': '{row}.price / 10000',
+        'date_week': "date({row}.date, 'weekday 0', '-6 days')",
+        'date_month': "strftime('%Y-%m-01', {row}.date)",
+        'date_year': "strftime('%Y-01-01', {row}.date)",
+    }
+    # dimensions whose summary rows keep engine_max (maximum engine per brand chart), the others leave it NULL:
+    # a max can't be decremented, so deleting a group's max vehicle rescans the group on (brand, type, engine)
+    ENGINE_MAX_DIMS = ('brand',)
+    # time rollups: summary dimension, first day of the bucket of a date, first day of the next bucket
+    PERIODS = {
+        'Day': ('date', lambda d: d, lambda d: d + timedelta(days=1)),
+        'Week': ('date_week', lambda d: d - timedelta(days=d.weekday()), lambda d: d + timedelta(days=7)),
+        'Month': ('date_month', lambda d: d.replace(day=1), lambda d: (d.replace(day=28) + timedelta(days=4)).replace(day=1)),
+        'Year': ('date_year', lambda d: d.replace(month=1, day=1), lambda d: d.replace(year=d.year + 1)),
+    }
+    # continuous summary dimensions, charted as histograms instead of one bar per distinct value
+    BINNED = ('engine', 'hp', 'kilometers', 'price')
+
+    def __init__(self, input_file, pool=None, pragmas=None, cache_size=1024, metrics=None, auditor=None) -> None:
         self.sql_file = os.path.join(os.path.dirname(__file__), input_file)
+        self.pool = pool or ConnectionPool(self.sql_file, pragmas=pragmas, metrics=metrics, auditor=auditor)
+        self.local = threading.local()
+        self.cache = QueryCache(cache_size)
 
         self.tb_name = 'vehicles'
         self.columns = ('id', 'type', 'brand', 'model', 'color', 'fuel', 'engine', 'hp', 'doors', 'sunroof', 'cases',
             'manufacture_year', 'status', 'kilometers', 'price', 'date')
+        # a None id is assigned atomically by sqlite (INTEGER PRIMARY KEY), a None date is today
+        self.insert_sql = 'INSERT OR IGNORE INTO {} ({}) VALUES ({}, COALESCE(?, date(\'now\')));'.format(
+            self.tb_name, ', '.join(self.columns), ', '.join('?' * (len(self.columns) - 1)))
+        self.fields = dict(zip(('ID', 'Type', 'Brand', 'Model', 'Color', 'Fuel', 'Engine', 'HP', 'Doors', 'Sunroof',
+            'Cases', 'Manufacture Year', 'Status', 'Kilometers', 'Price', 'Date Added'), self.columns))
         
         self.make_sql(os.path.dirname(__file__)+'/assets/vehicles.csv')
+        self.migrate()
+        self.summary_dims = self.summary_dims_installed()
+        if self.setting('summaries_deferred'):
+            # an import with deferred summaries didn't finish (or is still running in another process,
+            # which then keeps its rows in the summaries through the triggers and rebuilds them again at its end)
+            self.rebuild_summaries()
+        if auditor is not None:
+            with self.pool.connection() as con:
+                auditor.check_triggers(con, self.tb_name)
 
     @staticmethod
     def connect_to_db(func):
+        @functools.wraps(func)
         def wrapper(*args, **kw):
             self = args[0]
-            with sqlite3.connect(self.sql_file) as self.con:
-                #self.cur = self.con.cursor()
+            if getattr(self.local, 'con', None) is not None:
+                # nested call: stay in the caller's connection and transaction
                 return func(*args, **kw)
+            with self.pool.connection() as con:
+                self.local.con = con
+                try:
+                    with con:
+                        # commits on success, rolls back on error
+                        return func(*args, **kw)
+                finally:
+                    self.local.con = None
         return wrapper
 
+    @property
+    def con(self) -> sqlite3.Connection:
+        # connection checked out from the pool by the current thread
+        return self.local.con
+
     @connect_to_db
     def make_sql(self, csv_file) -> None:
         # one time use only bc my original database was in csv format
@@ -1002,53 +2101,609 @@ class DataBase:
         cur.execute('UPDATE {} SET sunroof="False" WHERE sunroof="0";'.format(self.tb_name))
 
     @connect_to_db
-    def get_all(self) -> list:
+    def migrate(self) -> int:
+        # brings existing database files up to the latest schema version
         cur = self.con.cursor()
-        cur.execute('SELECT * FROM {};'.format(self.tb_name))
-        return cur.fetchall()
+        while True:
+            # IMMEDIATE takes the write lock so concurrent workers don't migrate twice
+            cur.execute('BEGIN IMMEDIATE;')
+            version = cur.execute('PRAGMA user_version;').fetchone()[0]
+            if version >= len(self.MIGRATIONS):
+                self.con.commit()
+                return version
+            statements = self.MIGRATIONS[version]
+            if callable(statements):
+                # generated migrations
+                statements = statements(self)
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute('PRAGMA user_version = {};'.format(version + 1))
+            self.con.commit()
+
+    def summary_schema(self, dims) -> list:
+        # vehicle_summary holds count, count and sum of the non NULL prices and, for ENGINE_MAX_DIMS, max engine
+        # per (dimension, value, type); key is quote(value) because NULLs never conflict in a primary key
+        # the table is recreated and rebuilt every time, so it always has the columns of the current layout
+        statements = [
+            'CREATE TABLE IF NOT EXISTS summary_dims (dim TEXT PRIMARY KEY);',
+            'DELETE FROM summary_dims;',
+            'INSERT INTO summary_dims VALUES {};'.format(', '.join("('{}')".format(dim) for dim in dims)),
+            'DROP TABLE IF EXISTS vehicle_summary;',
+            '''CREATE TABLE vehicle_summary (
+                dim TEXT NOT NULL, key TEXT NOT NULL, value, type TEXT NOT NULL,
+                count INTEGER NOT NULL, price_count INTEGER NOT NULL, price_sum INTEGER NOT NULL, engine_max INTEGER,
+                PRIMARY KEY (dim, key, type)) WITHOUT ROWID;''',
+            'DROP TRIGGER IF EXISTS vehicles_summary_insert;',
+            'DROP TRIGGER IF EXISTS vehicles_summary_delete;',
+            'DROP TRIGGER IF EXISTS vehicles_summary_update;',
+        ]
+
+        def add(row):
+            return ['''INSERT INTO vehicle_summary (dim, key, value, type, count, price_count, price_sum, engine_max)
+                VALUES ('{dim}', quote({expr}), {expr}, {row}.type, 1, {row}.price IS NOT NULL, IFNULL({row}.price, 0), {engine})
+                ON CONFLICT (dim, key, type) DO UPDATE SET count = count + 1, price_count = price_count + excluded.price_count,
+                price_sum = price_sum + excluded.price_sum{update};
+                '''.format(dim=dim, expr=self.SUMMARY_DIMS[dim].format(row=row), row=row,
+                           engine='{}.engine'.format(row) if dim in self.ENGINE_MAX_DIMS else 'NULL',
+                           update=''',
+                engine_max = CASE WHEN engine_max IS NULL OR excluded.engine_max > engine_max THEN excluded.engine_max ELSE engine_max END'''
+                           if dim in self.ENGINE_MAX_DIMS else '') for dim in dims]
+
+        def remove(row):
+            # max can't be decremented: only rescan the group when its max vehicle leaves
+            return ['''UPDATE vehicle_summary SET count = count - 1, price_count = price_count - ({row}.price IS NOT NULL),
+                price_sum = price_sum - IFNULL({row}.price, 0){update}
+                WHERE dim = '{dim}' AND key = quote({expr}) AND type = {row}.type;
+                DELETE FROM vehicle_summary WHERE dim = '{dim}' AND key = quote({expr}) AND type = {row}.type AND count <= 0;
+                '''.format(dim=dim, expr=self.SUMMARY_DIMS[dim].format(row=row), row=row, update=''',
+                engine_max = CASE WHEN {row}.engine IS NULL OR {row}.engine < engine_max THEN engine_max
+                    ELSE (SELECT MAX(engine) FROM vehicles WHERE {cur} IS {expr} AND type = {row}.type) END'''.format(
+                    row=row, expr=self.SUMMARY_DIMS[dim].format(row=row), cur=self.SUMMARY_DIMS[dim].format(row='vehicles'))
+                    if dim in self.ENGINE_MAX_DIMS else '')
+                for dim in dims]
+
+        statements.append('CREATE TRIGGER vehicles_summary_insert AFTER INSERT ON vehicles BEGIN {} END;'.format(''.join(add('NEW'))))
+        statements.append('CREATE TRIGGER vehicles_summary_delete AFTER DELETE ON vehicles BEGIN {} END;'.format(''.join(remove('OLD'))))
+        statements.append('CREATE TRIGGER vehicles_summary_update AFTER UPDATE ON vehicles BEGIN {} {} END;'.format(
+            ''.join(remove('OLD')), ''.join(add('NEW'))))
+        statements.extend(self.summary_rebuild_sql(dims))
+        return statements
+
+    def change_log_schema(self, retention) -> list:
+        # keeps the last `retention` changes, versions are never reused (AUTOINCREMENT)
+        columns = ', '.join(self.columns)
+
+        def log(op, row):
+            return '''INSERT INTO change_log (op, {}) VALUES ('{}', {});
+                DELETE FROM change_log WHERE version <= (SELECT MAX(version) FROM change_log) - {};
+                '''.format(columns, op, ', '.join('{}.{}'.format(row, c) for c in self.columns), retention)
+
+        return [
+            '''CREATE TABLE IF NOT EXISTS change_log (version INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL,
+                id INTEGER, type TEXT, brand TEXT, model TEXT, color TEXT, fuel TEXT, engine INTEGER, hp INTEGER,
+                doors INTEGER, sunroof TEXT, cases INTEGER, manufacture_year INTEGER, status TEXT, kilometers INTEGER,
+                price INTEGER, date DATE);''',
+            'DROP TRIGGER IF EXISTS vehicles_log_insert;',
+            'DROP TRIGGER IF EXISTS vehicles_log_delete;',
+            'DROP TRIGGER IF EXISTS vehicles_log_update;',
+            'CREATE TRIGGER vehicles_log_insert AFTER INSERT ON vehicles BEGIN {} END;'.format(log('insert', 'NEW')),
+            'CREATE TRIGGER vehicles_log_delete AFTER DELETE ON vehicles BEGIN {} END;'.format(log('delete', 'OLD')),
+            'CREATE TRIGGER vehicles_log_update AFTER UPDATE ON vehicles BEGIN {} {} END;'.format(log('delete', 'OLD'), log('insert', 'NEW')),
+        ]
 
     @connect_to_db
-    def add_row(self, output) -> None:
+    def scope_version(self, condition='', params=()) -> int:
+        # version of the last write that touched a row matching condition (sql on the vehicles columns)
+        # when none is left in the log, the oldest version still logged is the conservative answer
         cur = self.con.cursor()
-        cur.execute('SELECT * FROM {} WHERE id = {};'.format(self.tb_name, output[0]))
-        if not cur.fetchone():
-            # if not found in db, add it
-            veh = str(output).replace('None', 'null')
-            cur.execute('INSERT INTO {}{} VALUES{};'.format(self.tb_name, self.columns, veh))
+        cur.execute('''SELECT COALESCE((SELECT MAX(version) FROM change_log {}), (SELECT MIN(version) - 1 FROM change_log), 0);
+            '''.format('WHERE {}'.format(condition) if condition else ''), tuple(params))
+        return cur.fetchone()[0]
+
+    def summary_rebuild_sql(self, dims) -> list:
+        return ['''INSERT INTO vehicle_summary (dim, key, value, type, count, price_count, price_sum, engine_max)
+            SELECT '{dim}', quote({expr}), {expr}, type, COUNT(*), COUNT(price), SUM(IFNULL(price, 0)), {engine}
+            FROM vehicles GROUP BY {expr}, type;'''.format(dim=dim, expr=self.SUMMARY_DIMS[dim].format(row='vehicles'),
+                                                           engine='MAX(engine)' if dim in self.ENGINE_MAX_DIMS else 'NULL')
+            for dim in dims]
 
     @connect_to_db
-    def delete_row(self, veh_tup) -> None:
+    def summary_dims_installed(self) -> tuple:
         cur = self.con.cursor()
-        cur.execute('DELETE FROM {} WHERE id = {};'.format(self.tb_name, veh_tup[0]))
+        cur.execute('SELECT dim FROM summary_dims;')
+        return tuple(row[0] for row in cur.fetchall())
 
     @connect_to_db
-    def custom_query(self, query) -> list:
+    def rebuild_summaries(self) -> None:
+        # for when the summaries drifted, e.g. after writes with the triggers dropped
+        # reinstalls the triggers and recomputes every group from the raw table
         cur = self.con.cursor()
-        cur.execute(query.format(self.tb_name))
-        return cur.fetchall()
+        cur.execute('BEGIN IMMEDIATE;')
+        for statement in self.summary_schema(self.summary_dims):
+            cur.execute(statement)
+        cur.execute("DELETE FROM settings WHERE name = 'summaries_deferred';")
+        cur.execute('UPDATE data_version SET version = version + 1;')
+
+    @connect_to_db
+    def check_summaries(self) -> list:
+        # rows that differ between the summary table and the raw vehicles table
+        cur = self.con.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS expected_summary AS SELECT * FROM vehicle_summary WHERE 0;')
+        cur.execute('DELETE FROM temp.expected_summary;')
+        for statement in self.summary_rebuild_sql(self.summary_dims):
+            cur.execute(statement.replace('INSERT INTO vehicle_summary', 'INSERT INTO temp.expected_summary', 1))
+        cur.execute('''SELECT 'missing', * FROM (SELECT * FROM temp.expected_summary EXCEPT SELECT * FROM vehicle_summary)
+            UNION ALL SELECT 'unexpected', * FROM (SELECT * FROM vehicle_summary EXCEPT SELECT * FROM temp.expected_summary)
+            ORDER BY 2, 3, 5;''')
+        drift = cur.fetchall()
+        cur.execute('DROP TABLE temp.expected_summary;')
+        return drift
+
+    @connect_to_db
+    def summary(self, dim, type=None, by_type=True) -> list:
+        # (value, [type,] count, price_count, price_sum, engine_max) per group, O(groups) instead of O(vehicles),
+        # engine_max is None outside of ENGINE_MAX_DIMS
+        def run():
+            cur = self.con.cursor()
+            group = 'value, type' if by_type else 'value'
+            where = 'dim = ? AND type = ?' if type else 'dim = ?'
+            params = (dim, type) if type else (dim,)
+            cur.execute('''SELECT {0}, SUM(count), SUM(price_count), SUM(price_sum), MAX(engine_max) FROM vehicle_summary
+                WHERE {1} GROUP BY {0} ORDER BY {0};'''.format(group, where), params)
+            return cur.fetchall()
+        return self.cache.get(('summary', dim, type, by_type, self.data_version()), run)
 
     @connect_to_db
-    def select_type(self, value) -> list:
-        if value not in ('Car', 'Motorbike'):
+    def count_per_period(self, period, start, end) -> list:
+        # (bucket, type, count, all types count) per Day/Week/Month/Year bucket of the vehicles added between start and end
+        # whole buckets are read from their rollup, only the partly covered buckets at the edges are summed from daily counts,
+        # so both parts are primary key range scans over (dim, key)
+        if start is None or end is None:
+            # no vehicles, get_min_of/get_max_of of an empty table
             return []
+        dim, bucket, following = self.PERIODS[period]
+        start, end = date.fromisoformat(start[:10]), date.fromisoformat(end[:10])
+        # whole buckets are [first, last), the days in [start, first) and [last, end] are the edges
+        first = bucket(start) if bucket(start) == start else following(bucket(start))
+        last = max(bucket(end + timedelta(days=1)), first)
+        edge = min(first, end + timedelta(days=1))
+
+        def run():
+            cur = self.con.cursor()
+            cur.execute('''SELECT freq, type, SUM(count), SUM(SUM(count)) OVER (PARTITION BY freq) FROM (
+                    SELECT value AS freq, type, count FROM vehicle_summary
+                    WHERE dim = ? AND key >= quote(?) AND key < quote(?)
+                    UNION ALL
+                    SELECT {} AS freq, type, count FROM vehicle_summary
+                    WHERE dim = 'date' AND (key >= quote(?) AND key < quote(?) OR key >= quote(?) AND key <= quote(?)))
+                GROUP BY freq, type ORDER BY freq;'''.format(self.SUMMARY_DIMS[dim].replace('{row}.date', 'value')),
+                (dim, first.isoformat(), last.isoformat(), start.isoformat(), edge.isoformat(), last.isoformat(), end.isoformat()))
+            return cur.fetchall()
+        return self.cache.get(('count_per_period', period, start, end, self.data_version()), run)
+
+    @connect_to_db
+    def aggregates(self, dims=('fuel', 'color', 'status', 'brand')) -> dict:
+        # every chart measure of the given dimensions in one statement over the summary table,
+        # UNION ALL emulates GROUPING SETS ((dim, value, type), (dim, value), (dim, type)):
+        # {dim: {'by_type': [(value, type, count, price_count, price_sum, engine_max)],
+        #        'all': [(value, count, price_count, price_sum, engine_max)], 'types': [(type, count, price_count, price_sum, engine_max)]}}
+        def run():
+            cur = self.con.cursor()
+            cur.execute('''WITH s AS (SELECT * FROM vehicle_summary WHERE dim IN ({}))
+                SELECT 'by_type', dim, value, type, count, price_count, price_sum, engine_max FROM s
+                UNION ALL
+                SELECT 'all', dim, value, NULL, SUM(count), SUM(price_count), SUM(price_sum), MAX(engine_max) FROM s GROUP BY dim, key
+                UNION ALL
+                SELECT 'types', dim, NULL, type, SUM(count), SUM(price_count), SUM(price_sum), MAX(engine_max) FROM s GROUP BY dim, type
+                ORDER BY 1, 2, 3, 4;'''.format(', '.join('?' * len(dims))), dims)
+
+            result = {dim: {'by_type': [], 'all': [], 'types': []} for dim in dims}
+            for level, dim, value, type, *measures in cur.fetchall():
+                if level == 'by_type':
+                    result[dim][level].append((value, type, *measures))
+                elif level == 'all':
+                    result[dim][level].append((value, *measures))
+                else:
+                    result[dim][level].append((type, *measures))
+            return result
+        return self.cache.get(('aggregates', tuple(dims), self.data_version()), run)
+
+    @staticmethod
+    def bin_edges(values, weights, bins, method='fd') -> np.ndarray:
+        # edges of at most `bins` bins over the weighted values, 'fd' uses the Freedman-Diaconis width rounded up
+        # to a 1/2/2.5/5 step so the labels stay readable, 'quantile' puts about the same count in every bin
+        order = np.argsort(values)
+        values, weights = values[order], weights[order]
+        cdf = np.cumsum(weights) / weights.sum()
+        quantile = lambda q: values[np.minimum(np.searchsorted(cdf, q), len(values) - 1)]
+        low, high = values[0], values[-1]
+        if low == high:
+            return np.array([low, low + 1])
+
+        if method == 'quantile':
+            inner = np.unique(quantile(np.linspace(0, 1, bins + 1)[1:-1]))
+            return np.concatenate(([low], inner[(low < inner) & (inner < high)], [high]))
+
+        iqr = quantile(0.75) - quantile(0.25)
+        width = max(2 * iqr * weights.sum() ** (-1 / 3), (high - low) / bins)
+        exponent = 10 ** np.floor(np.log10(width))
+        for step in (m * exponent for m in (1, 2, 2.5, 5, 10, 20, 25, 50, 100)):
+            start = np.floor(low / step) * step
+            count = max(1, int(np.ceil((high - start) / step)))
+            if step >= width and count <= bins:
+                break
+        return start + step * np.arange(count + 1)
+
+    @connect_to_db
+    def histogram(self, dim, type=None, bins=40, method='fd') -> list:
+        # (low, high, type, count) per bin and type from the per value counts of a summary dimension,
+        # every type shares the same edges so the bars stack
+        def run():
+            rows = [row for row in self.summary(dim, type) if row[0] is not None]
+            if not rows:
+                return []
+            values = np.array([row[0] for row in rows], dtype=float)
+            types = np.array([row[1] for row in rows], dtype=object)
+            counts = np.array([row[2] for row in rows], dtype=float)
+            edges = self.bin_edges(values, counts, bins, method)
+
+            result = []
+            for t in sorted(set(types)):
+                hist, _ = np.histogram(values[types == t], bins=edges, weights=counts[types == t])
+                result += [(low.item(), high.item(), t, int(c)) for low, high, c in zip(edges[:-1], edges[1:], hist)]
+            return result
+        return self.cache.get(('histogram', dim, type, bins, method, self.data_version()), run)
+
+    @connect_to_db
+    def get_all(self) -> list:
         cur = self.con.cursor()
-        cur.execute('SELECT * FROM {} WHERE type = "{}";'.format(self.tb_name, value))
+        cur.execute('SELECT * FROM {};'.format(self.tb_name))
         return cur.fetchall()
 
+    def parse_filter(self, filter_query) -> tuple:
+        # translates a dash datatable filter_query into a parameterized sql condition
+        # e.g. '{Engine} > 1500 and {Brand} contains "Ford"' -> ('("engine" > ? AND instr("brand", ?) > 0)', [1500, 'Ford'])
+        token_re = re.compile(r'''\s*(?:(?P<col>\{(?:[^}\\]|\\.)*\})|(?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\]|\\.)*`)|(?P<op>&&|\|\||[is]?(?:!=|<=|>=|=|<|>)|!|\(|\))|(?P<word>[^\s(){}"'`!=<>]+))''')
+        relational = {'=': '=', 'eq': '=', '!=': '!=', 'ne': '!=', '<': '<', 'lt': '<', '<=': '<=', 'le': '<=',
+                      '>': '>', 'gt': '>', '>=': '>=', 'ge': '>=', 'contains': 'contains', 'datestartswith': 'datestartswith'}
+        unary = {'blank': '({0} IS NULL OR {0} = \'\')', 'nil': '{0} IS NULL', 'num': 'typeof({0}) IN (\'integer\', \'real\')',
+                 'str': 'typeof({0}) = \'text\'', 'even': '{0} % 2 = 0', 'odd': '{0} % 2 = 1'}
+
+        tokens = []
+        pos = 0
+        query = filter_query.strip()
+        while pos < len(query):
+            match = token_re.match(query, pos)
+            if not match:
+                raise ValueError('Invalid filter query near: {}'.format(query[pos:]))
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind)))
+            pos = match.end()
+
+        params = []
+        pos = 0
+
+        def peek():
+            return tokens[pos] if pos < len(tokens) else (None, None)
+
+        def take():
+            nonlocal pos
+            if pos >= len(tokens):
+                raise ValueError('Unexpected end of filter query')
+            pos += 1
+            return tokens[pos-1]
+
+        def parse_value():
+            kind, value = take()
+            if kind == 'str':
+                return re.sub(r'\\(.)', r'\1', value[1:-1])
+            if kind != 'word':
+                raise ValueError('Expected a value, got: {}'.format(value))
+            try:
+                return int(value)
+            except ValueError:
+                pass
+            try:
+                return float(value)
+            except ValueError:
+                return value
+
+        def parse_comparison():
+            kind, value = take()
+            if kind != 'col':
+                raise ValueError('Expected a column, got: {}'.format(value))
+            label = re.sub(r'\\(.)', r'\1', value[1:-1])
+            if label not in self.fields:
+                raise ValueError('Unknown column: {}'.format(label))
+            column = '"{}"'.format(self.fields[label])
+
+            kind, op = take()
+            if op == 'is':
+                kind, test = take()
+                if test not in unary:
+                    raise ValueError('Unsupported test: is {}'.format(test))
+                return unary[test].format(column)
+
+            # case prefixes: 'i' insensitive, 's' sensitive (default)
+            nocase = False
+            if op not in relational and op[:1] in ('i', 's') and op[1:] in relational:
+                nocase = op[0] == 'i'
+                op = op[1:]
+            if op not in relational:
+                raise ValueError('Unsupported operator: {}'.format(op))
+            op = relational[op]
+            value = parse_value()
+
+            if op == 'contains':
+                if nocase:
+                    params.append('%{}%'.format(str(value).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')))
+                    return '{} LIKE ? ESCAPE \'\\\''.format(column)
+                params.append(str(value))
+                return 'instr({}, ?) > 0'.format(column)
+            if op == 'datestartswith':
+                params.append(str(value))
+                return 'instr({}, ?) = 1'.format(column)
+            params.append(value)
+            return '{} {} ?{}'.format(column, op, ' COLLATE NOCASE' if nocase else '')
+
+        def parse_unary():
+            kind, value = peek()
+            if value == '!':
+                take()
+                return 'NOT ({})'.format(parse_unary())
+            if value == '(':
+                take()
+                expr = parse_or()
+                if take()[1] != ')':
+                    raise ValueError('Missing closing parenthesis')
+                # parse_and and parse_or already parenthesize what they join
+                return expr
+            return parse_comparison()
+
+        def parse_and():
+            exprs = [parse_unary()]
+            while peek()[1] in ('&&', 'and'):
+                take()
+                exprs.append(parse_unary())
+            return exprs[0] if len(exprs) == 1 else '({})'.format(' AND '.join(exprs))
+
+        def parse_or():
+            exprs = [parse_and()]
+            while peek()[1] in ('||', 'or'):
+                take()
+                exprs.append(parse_and())
+            return exprs[0] if len(exprs) == 1 else '({})'.format(' OR '.join(exprs))
+
+        if not tokens:
+            return '', []
+        condition = parse_or()
+        if pos != len(tokens):
+            raise ValueError('Unexpected token in filter query: {}'.format(tokens[pos][1]))
+        return condition, params
+
+    def parse_sort(self, sort_by) -> str:
+        # always end with the primary key so that pages are stable
+        order = ['"{}" {}'.format(self.fields[s['column_id']], 'DESC' if s['direction'] == 'desc' else 'ASC')
+                 for s in (sort_by or []) if s['column_id'] in self.fields]
+        order.append('id ASC')
+        return ', '.join(order)
+
     @connect_to_db
-    def count_field(self, field, type=None) -> list:
+    def count_rows(self, filter_query='') -> int:
+        condition, params = self.parse_filter(filter_query or '')
+        where = 'WHERE {}'.format(condition) if condition else ''
         cur = self.con.cursor()
-        if not type:
-            cur.execute('SELECT {}, Count(id) FROM {} GROUP BY {};'.format(field, self.tb_name, field))
-        else:
-            cur.execute('SELECT {}, Count(id) FROM {} WHERE type = "{}" GROUP BY {};'.format(field, self.tb_name, type, field))
+        cur.execute('SELECT COUNT(*) FROM {} {};'.format(self.tb_name, where), params)
+        return cur.fetchone()[0]
+
+    @connect_to_db
+    def get_page(self, page, page_size, filter_query='', sort_by=None) -> list:
+        condition, params = self.parse_filter(filter_query or '')
+        where = 'WHERE {}'.format(condition) if condition else ''
+        cur = self.con.cursor()
+        cur.execute('SELECT * FROM {} {} ORDER BY {} LIMIT ? OFFSET ?;'.format(self.tb_name, where, self.parse_sort(sort_by)),
+                    params + [page_size, page*page_size])
         return cur.fetchall()
-    
+
+    def iter_rows(self, filter_query='', sort_by=None, chunk_size=5000):
+        # yields lists of rows from a server-side cursor on a connection outside the pool,
+        # a slow download must not hold one of the connections the callbacks wait for
+        condition, params = self.parse_filter(filter_query or '')
+        where = 'WHERE {}'.format(condition) if condition else ''
+        con = self.pool.open()
+        try:
+            cur = con.execute('SELECT * FROM {} {} ORDER BY {};'.format(self.tb_name, where, self.parse_sort(sort_by)), params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # also runs when the client disconnects mid-download
+            con.close()
+
+    def normalize_chunk(self, df) -> tuple:
+        # vectorized validation of one csv chunk, returns (rows ready to insert, [(line, reason), ...])
+        df = df.rename(columns=lambda c: self.fields.get(c.strip(), c.strip().lower()))
+        missing = [c for c in self.columns if c not in ('id', 'date') and c not in df.columns]
+        if missing:
+            raise ValueError('Missing columns: {}'.format(', '.join(missing)))
+
+        def text(column):
+            return df[column].astype('string').str.strip().replace('', pd.NA)
+
+        def is_true(mask):
+            return mask.fillna(False).astype(bool)
+
+        out = pd.DataFrame(index=df.index)
+        out['type'] = text('type').str.capitalize()
+        out['brand'] = text('brand')
+        out['model'] = text('model')
+        out['color'] = text('color').str.lower()
+        out['fuel'] = text('fuel')
+        out['status'] = text('status').str.capitalize()
+        numeric = ('engine', 'hp', 'doors', 'cases', 'manufacture_year', 'kilometers', 'price')
+        for column in numeric:
+            out[column] = pd.to_numeric(df[column], errors='coerce')
+        out['sunroof'] = text('sunroof').str.lower().map({'1': 'True', '1.0': 'True', 'true': 'True', 'yes': 'True',
+                                                          '0': 'False', '0.0': 'False', 'false': 'False', 'no': 'False'})
+        raw_date = text('date') if 'date' in df.columns else pd.Series(pd.NA, index=df.index, dtype='string')
+        dates = pd.to_datetime(raw_date, errors='coerce')
+        out['date'] = dates.dt.strftime('%Y-%m-%d').where(dates.notna(), date.today().isoformat())
+
+        car = is_true(out['type'] == 'Car')
+        moto = is_true(out['type'] == 'Motorbike')
+        required = ['engine', 'hp', 'manufacture_year', 'kilometers', 'price']
+        values = out[list(numeric)]
+        # same rules as the insert form, the first failing check is the reported reason
+        checks = [
+            (~(car | moto), 'invalid type'),
+            (out[['brand', 'model', 'color', 'fuel', 'status']].isna().any(axis=1), 'missing text field'),
+            (~out['status'].isin(['New', 'Used']), 'invalid status'),
+            (out[required].isna().any(axis=1), 'missing or non-numeric number field'),
+            ((values < 0).any(axis=1), 'negative number'),
+            ((values % 1 > 0).any(axis=1), 'non-integer number'),
+            (car & (out['doors'].isna() | out['sunroof'].isna()), 'car without doors or sunroof'),
+            (moto & out['cases'].isna(), 'motorbike without cases'),
+            (raw_date.notna() & dates.isna(), 'invalid date'),
+        ]
+        reason = pd.Series(np.select([is_true(mask).to_numpy() for mask, _ in checks], [r for _, r in checks], ''), index=df.index)
+
+        clean = out[reason == '']
+        clean_car = car[reason == '']
+        columns = []
+        for column in self.columns[1:]:
+            if column in ('doors', 'sunroof'):
+                series = clean[column].where(clean_car)
+            elif column == 'cases':
+                series = clean[column].where(~clean_car)
+            else:
+                series = clean[column]
+            if column in numeric:
+                columns.append([None if pd.isna(v) else int(v) for v in series.tolist()])
+            else:
+                columns.append([None if pd.isna(v) else v for v in series.tolist()])
+
+        rejected = [(line + 2, r) for line, r in reason[reason != ''].items()]  # +2: header and 1-based lines
+        return list(zip(*columns)), rejected
+
+    @connect_to_db
+    def insert_rows(self, rows) -> int:
+        # one transaction for the whole batch, ids are assigned by sqlite
+        cur = self.con.cursor()
+        cur.executemany('INSERT INTO {} ({}) VALUES ({});'.format(
+            self.tb_name, ', '.join(self.columns[1:]), ', '.join('?' * (len(self.columns) - 1))), rows)
+        return cur.rowcount
+
+    def import_csv(self, source, chunk_size=50000, defer_summaries=False, compression='infer', progress=None) -> dict:
+        # streams a csv (path or file object) in chunks so memory stays bounded for any file size
+        # defer_summaries drops the summary triggers and rebuilds the summaries once at the end,
+        # much faster for millions of rows but the charts lag behind until the import finishes;
+        # the 'summaries_deferred' setting marks it, so a killed import is rebuilt on the next startup
+        report = {'rows': 0, 'rejected': 0, 'errors': [], 'seconds': 0.0, 'rows_per_second': 0.0}
+        start = time.perf_counter()
+        if defer_summaries:
+            with self.pool.connection() as con:
+                with con:
+                    for trigger in ('insert', 'delete', 'update'):
+                        con.execute('DROP TRIGGER IF EXISTS vehicles_summary_{};'.format(trigger))
+                    con.execute("INSERT OR REPLACE INTO settings VALUES ('summaries_deferred', '1');")
+        try:
+            for chunk in pd.read_csv(source, chunksize=chunk_size, dtype=str, compression=compression):
+                rows, rejected = self.normalize_chunk(chunk)
+                report['rows'] += self.insert_rows(rows) if rows else 0
+                report['rejected'] += len(rejected)
+                report['errors'].extend(rejected[:100 - len(report['errors'])])  # keep a sample only
+                report['seconds'] = time.perf_counter() - start
+                report['rows_per_second'] = report['rows'] / report['seconds']
+                if progress:
+                    progress(report)
+        finally:
+            if defer_summaries:
+                self.rebuild_summaries()
+        report['seconds'] = time.perf_counter() - start
+        report['rows_per_second'] = report['rows'] / report['seconds'] if report['seconds'] else 0.0
+        return report
+
+    def iter_snapshot(self, chunk_size=50000):
+        # yields (change log version, rows) chunks of one consistent read of the whole table
+        with self.pool.connection() as con:
+            cur = con.cursor()
+            try:
+                cur.execute('BEGIN;')
+                cur.execute('SELECT COALESCE(MAX(version), 0) FROM change_log;')
+                version = cur.fetchone()[0]
+                cur.execute('SELECT * FROM {} ORDER BY id;'.format(self.tb_name))
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield version, rows
+            finally:
+                cur.close()
+                con.rollback()
+
+    @connect_to_db
+    def changes_since(self, version) -> tuple:
+        # (horizon, changes): changes after version, horizon is the newest version already pruned from the log
+        cur = self.con.cursor()
+        cur.execute('SELECT COALESCE(MIN(version) - 1, 0) FROM change_log;')
+        horizon = cur.fetchone()[0]
+        cur.execute('SELECT version, op, {} FROM change_log WHERE version > ? ORDER BY version;'.format(', '.join(self.columns)), (version,))
+        return horizon, cur.fetchall()
+
+    @connect_to_db
+    def add_row(self, output) -> int:
+        # returns the id of the new vehicle, None if the id already existed
+        cur = self.con.cursor()
+        cur.execute(self.insert_sql, tuple(output))
+        return cur.lastrowid if cur.rowcount else None
+
+    @connect_to_db
+    def delete_row(self, veh_tup) -> None:
+        self.apply_changes(delete_rows=[veh_tup])
+
+    @connect_to_db
+    def apply_changes(self, add_rows=(), delete_rows=()) -> None:
+        # all inserts and deletes in one transaction (one fsync)
+        # rows whose id already exists are left untouched, like add_row always did
+        cur = self.con.cursor()
+        cur.executemany(self.insert_sql, [tuple(row) for row in add_rows])
+        cur.executemany('DELETE FROM {} WHERE id = ?;'.format(self.tb_name), [(row[0],) for row in delete_rows])
+
     @connect_to_db
-    def get_curr_date(self) -> str:
+    def data_version(self) -> int:
+        # bumped by triggers in the same transaction as any write, from any process
         cur = self.con.cursor()
-        cur.execute('SELECT date(\'now\');')
+        cur.execute('SELECT version FROM data_version;')
         return cur.fetchone()[0]
+
+    @connect_to_db
+    def setting(self, name) -> str:
+        cur = self.con.cursor()
+        cur.execute('SELECT value FROM settings WHERE name = ?;', (name,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    @connect_to_db
+    def count_field(self, field, type=None) -> list:
+        fields = [f.strip() for f in field.split(',')]
+        dims = [f for f in fields if f != 'type']
+        if len(dims) == 1 and dims[0] in self.summary_dims and len(fields) <= 2:
+            # answer from the summary table, keeping the column order of the GROUP BY
+            rows = self.summary(dims[0], type, by_type='type' in fields)
+            if fields == ['type', dims[0]]:
+                return [(t, v, c) for v, t, c, _, _, _ in rows]
+            return [row[:-3] for row in rows]
+
+        def run():
+            cur = self.con.cursor()
+            if not type:
+                cur.execute('SELECT {}, Count(id) FROM {} GROUP BY {};'.format(field, self.tb_name, field))
+            else:
+                cur.execute('SELECT {}, Count(id) FROM {} WHERE type = "{}" GROUP BY {};'.format(field, self.tb_name, type, field))
+            return cur.fetchall()
+        return self.cache.get(('count_field', field, type, self.data_version()), run)
     
     @connect_to_db
     def get_min_of(self, field) -> str:
@@ -1063,38 +2718,64 @@ class DataBase:
         return cur.fetchone()[0]
 
     @connect_to_db
-    def find_similar(self, similar_table, veh_tup) -> list:
+    def find_similar(self, veh_tup) -> list:
+        # vehicles of the same type, brand and model followed by the candidate itself
+        # read-only lookup on idx_vehicles_type_brand_model, no schema lock so submissions can run concurrently
         cur = self.con.cursor()
-        cur.execute('CREATE TABLE {} AS SELECT * FROM {} WHERE type = "{}" AND brand = "{}" AND model = "{}";'.format(similar_table, self.tb_name, veh_tup[1], veh_tup[2], veh_tup[3]))
-        veh = str(veh_tup).replace('None', 'null')
-        cur.execute('INSERT INTO {}{} VALUES{};'.format(similar_table, self.columns, veh))
-        cur.execute('SELECT * FROM {}'.format(similar_table))
-        return cur.fetchall()
-    
-    @connect_to_db
-    def drop_table(self, similar_table) -> None:
-        cur = self.con.cursor()
-        cur.execute('DROP TABLE {};'.format(similar_table))
+        cur.execute('SELECT * FROM {} WHERE type = ? AND brand = ? AND model = ? ORDER BY id;'.format(self.tb_name), veh_tup[1:4])
+        return cur.fetchall() + [tuple(veh_tup)]
 
 class UserDB:
-    def __init__(self, input_file) -> None:
+    class Throttled(Exception):
+        # login refused without checking the password, the message is shown to the user
+        pass
+
+    def __init__(self, input_file, pool=None, pragmas=None, rounds=12, workers=2, max_pending=16,
+                 max_attempts=5, attempt_window=60) -> None:
         self.users_file = os.path.join(os.path.dirname(__file__), input_file)
+        self.pool = pool or ConnectionPool(self.users_file, pragmas=pragmas)
+        self.local = threading.local()
 
         self.tb_name = 'users'
         self.columns = ('username', 'password')
 
-        self.salt = bcrypt.gensalt()
+        # bcrypt cost factor of new hashes, stored hashes with another cost are rehashed on login
+        self.rounds = rounds
+        # bcrypt releases the GIL, the pool bounds the cores spent on hashing so logins can't starve the other callbacks
+        self.verifier = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self.pending = threading.BoundedSemaphore(max_pending)
+        # failed attempts per username within attempt_window seconds
+        self.max_attempts = max_attempts
+        self.attempt_window = attempt_window
+        self.failures = collections.defaultdict(collections.deque)
+        self.failures_lock = threading.Lock()
+        # checked against for unknown usernames, so they take as long as known ones
+        self.dummy_hash = bcrypt.hashpw(b'', bcrypt.gensalt(rounds)).decode()
 
         self.create_table()
 
     @staticmethod
     def connect_to_db(func):
+        @functools.wraps(func)
         def wrapper(*args, **kw):
             self = args[0]
-            with sqlite3.connect(self.users_file) as self.con:
-                #self.cur = self.con.cursor()
+            if getattr(self.local, 'con', None) is not None:
+                # nested call: stay in the caller's connection and transaction
                 return func(*args, **kw)
+            with self.pool.connection() as con:
+                self.local.con = con
+                try:
+                    with con:
+                        # commits on success, rolls back on error
+                        return func(*args, **kw)
+                finally:
+                    self.local.con = None
         return wrapper
+
+    @property
+    def con(self) -> sqlite3.Connection:
+        # connection checked out from the pool by the current thread
+        return self.local.con
     
     @connect_to_db
     def create_table(self) -> None:
@@ -1115,22 +2796,99 @@ class UserDB:
         for user in initial_users:
             self.add_user(user)
 
+    def hash_password(self, password) -> str:
+        # a fresh salt per hash
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+
     @connect_to_db
     def add_user(self, user) -> None:
         cur = self.con.cursor()
-        pass_hashed = bcrypt.hashpw(user[1].encode(), self.salt)
-        user_hashed = (user[0], pass_hashed.decode())
-        cur.execute('INSERT INTO {}{} VALUES{};'.format(self.tb_name, self.columns, user_hashed))
+        cur.execute('INSERT INTO {} (username, password) VALUES (?, ?);'.format(self.tb_name), (user[0], self.hash_password(user[1])))
 
     @connect_to_db
-    def check_password(self, username, password) -> list:
+    def password_hash(self, username) -> str:
         cur = self.con.cursor()
-        cur.execute('SELECT * FROM {} WHERE username = "{}";'.format(self.tb_name, username))
-        user = cur.fetchone()
-        if user:
-            return bcrypt.checkpw(password.encode(), user[1].encode())
-        return False
+        cur.execute('SELECT password FROM {} WHERE username = ?;'.format(self.tb_name), (username,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    @connect_to_db
+    def needs_rehash(self, stored) -> bool:
+        # other cost factor or bcrypt version, or a salt shared with another user (hashes made with one salt per process)
+        prefix, rounds = stored.split('$')[1:3]
+        if prefix != '2b' or int(rounds) != self.rounds:
+            return True
+        cur = self.con.cursor()
+        cur.execute('SELECT COUNT(*) FROM {} WHERE substr(password, 1, 29) = ?;'.format(self.tb_name), (stored[:29],))
+        return cur.fetchone()[0] > 1
+
+    @connect_to_db
+    def rehash(self, username, password, stored) -> None:
+        cur = self.con.cursor()
+        cur.execute('UPDATE {} SET password = ? WHERE username = ? AND password = ?;'.format(self.tb_name),
+                    (self.hash_password(password), username, stored))
+
+    def throttle(self, username) -> None:
+        with self.failures_lock:
+            failures = self.failures.get(username, ())
+            while failures and failures[0] < time.monotonic() - self.attempt_window:
+                failures.popleft()
+            if not failures:
+                # forgets usernames without recent failures
+                self.failures.pop(username, None)
+            elif len(failures) >= self.max_attempts:
+                wait = int(failures[0] + self.attempt_window - time.monotonic()) + 1
+                raise self.Throttled('Too many failed attempts, try again in {} s.'.format(wait))
+
+    def check_password(self, username, password) -> bool:
+        # the hash is checked on the bounded verifier pool, with no database connection held meanwhile
+        self.throttle(username)
+        if not self.pending.acquire(blocking=False):
+            raise self.Throttled('Too many logins in progress, try again shortly.')
+        try:
+            stored = self.password_hash(username)
+            correct = self.verifier.submit(bcrypt.checkpw, password.encode(), (stored or self.dummy_hash).encode()).result()
+        finally:
+            self.pending.release()
+        correct = correct and stored is not None
+
+        with self.failures_lock:
+            if correct:
+                self.failures.pop(username, None)
+            else:
+                self.failures[username].append(time.monotonic())
+        if correct and self.needs_rehash(stored):
+            # in the background, the login doesn't wait for it
+            self.verifier.submit(self.rehash, username, password, stored)
+        return correct
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Carly: My Car Project')
+    parser.add_argument('--rebuild-summaries', action='store_true', help='recompute the summary table from the vehicles table and exit')
+    parser.add_argument('--check-summaries', action='store_true', help='compare the summary table with the vehicles table and exit')
+    parser.add_argument('--import', dest='import_file', metavar='CSV', help='bulk import vehicles from a (optionally gzipped) csv and exit')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='rows per batch/transaction for --import')
+    parser.add_argument('--defer-summaries', action='store_true', help='rebuild the summaries once after --import instead of per row')
+    args = parser.parse_args()
+
+    if args.import_file:
+        db = DataBase('database.db')
+        report = db.import_csv(args.import_file, args.chunk_size, args.defer_summaries,
+                               progress=lambda r: print('{rows} rows imported, {rejected} rejected, {rows_per_second:.0f} rows/s'.format(**r)))
+        for line, reason in report['errors']:
+            print('line {}: {}'.format(line, reason))
+        print('Imported {rows} rows in {seconds:.1f}s ({rows_per_second:.0f} rows/s), rejected {rejected}'.format(**report))
+        raise SystemExit(0)
+
+    if args.rebuild_summaries or args.check_summaries:
+        db = DataBase('database.db')
+        if args.rebuild_summaries:
+            db.rebuild_summaries()
+        drift = db.check_summaries()
+        for row in drift:
+            print(*row, sep='\t')
+        print('{} drifted summary rows'.format(len(drift)))
+        raise SystemExit(1 if drift else 0)
+
     web = Carly(title='Carly: My Car Project', db_file='database.db')
     web.app.run_server()
\ No newline at end of file
@@ -0,0 +1,42 @@
+// pure UI callbacks, run in the browser without a request to the server
+// registered in Carly.callbacks with ClientsideFunction('carly', <name>)
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    carly: {
+        toggle_navbar_collapse: function(n_clicks, is_open) {
+            if (n_clicks) {
+                return !is_open;
+            }
+            return is_open;
+        },
+
+        disable_inputs: function(veh_type) {
+            // doors, sunroof, cases
+            if (veh_type === 'Car') {
+                return [false, false, true];
+            } else if (veh_type === 'Motorbike') {
+                return [true, true, false];
+            }
+            return [true, true, true];
+        },
+
+        style_active_row: function(active_cell, style_cond) {
+            if (!active_cell) {
+                return window.dash_clientside.no_update;
+            }
+            const new_style_cond = (style_cond || []).filter(d => d.backgroundColor !== '#ff413633');
+            new_style_cond.push({'if': {'row_index': active_cell.row}, 'backgroundColor': '#ff413633'});
+            return new_style_cond;
+        },
+
+        filter_sort_action: function(table_switch) {
+            // sort_action, filter_action, custom filter input disabled
+            const switch_on = table_switch || [];
+            const filter = switch_on.includes('Filter');
+            return [switch_on.includes('Sort') ? 'custom' : 'none', filter ? 'custom' : 'none', !filter];
+        },
+
+        write_query: function(query) {
+            return query == null ? '' : query;
+        }
+    }
+});
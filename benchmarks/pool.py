@@ -0,0 +1,86 @@
+"""Compares connect-per-call against the pooled connections used by DataBase.
+
+Run from the repository root:  python -m benchmarks.pool [--repeat 200]
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from app import DataBase
+
+# roughly the queries fired by one visit of the charts page
+CHART_QUERIES = (
+    'SELECT MIN(date) FROM {};',
+    'SELECT date AS freq, type, COUNT(id) FROM {} GROUP BY freq, type ORDER BY freq;',
+    'SELECT date AS freq, COUNT(id) FROM {} GROUP BY freq ORDER BY freq;',
+    'SELECT date, Count(id) FROM {} GROUP BY date;',
+    'SELECT type, fuel, Count(id) FROM {} GROUP BY type, fuel;',
+    'SELECT * FROM {};',
+    'SELECT FLOOR(price / 10000) as floor, COUNT(id) FROM {} GROUP BY floor',
+    'SELECT type, status, AVG(price) FROM {} GROUP BY type, status',
+    'SELECT status, AVG(price) FROM {} GROUP BY status',
+    'SELECT brand, AVG(price) FROM {} GROUP BY brand',
+    'SELECT brand, MAX(engine) FROM {} GROUP BY brand',
+    'SELECT color, Count(id) FROM {} GROUP BY color;',
+    'SELECT brand, type, Count(id) FROM {} GROUP BY brand, type;',
+)
+
+
+def connect_per_call(db_file, query):
+    # what every DataBase method did before the pool
+    with sqlite3.connect(db_file) as con:
+        return con.execute(query.format('vehicles')).fetchall()
+
+
+def pooled_call(db, query):
+    # goes through the pool directly, the DataBase methods would answer from their result cache
+    with db.pool.connection() as con:
+        return con.execute(query.format(db.tb_name)).fetchall()
+
+
+def time_callbacks(run, repeat):
+    timings = []
+    for _ in range(repeat):
+        for query in CHART_QUERIES:
+            start = time.perf_counter()
+            run(query)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name, timings):
+    print('{:<18} mean {:8.1f}us   median {:8.1f}us   p95 {:8.1f}us'.format(
+        name,
+        statistics.mean(timings) * 1e6,
+        statistics.median(timings) * 1e6,
+        sorted(timings)[int(len(timings) * 0.95)] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=200, help='visits of the charts page to simulate')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), '..', 'database.db'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # never touch the real database, WAL mode is persistent
+        db_file = os.path.join(tmp, 'bench.db')
+        shutil.copy(args.db, db_file)
+
+        legacy = time_callbacks(lambda q: connect_per_call(db_file, q), args.repeat)
+        db = DataBase(db_file)
+        pooled = time_callbacks(lambda q: pooled_call(db, q), args.repeat)
+        db.pool.close()
+
+    report('connect-per-call', legacy)
+    report('pooled', pooled)
+    saved = statistics.mean(legacy) - statistics.mean(pooled)
+    print('saved per callback: {:.1f}us ({:.0f}%)'.format(saved * 1e6, 100 * saved / statistics.mean(legacy)))
+
+
+if __name__ == '__main__':
+    main()
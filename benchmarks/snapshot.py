@@ -0,0 +1,92 @@
+"""Compares the dashboard's group-by patterns on SQLite against VehicleSnapshot.
+
+Run from the repository root:  python -m benchmarks.snapshot [--rows 200000]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from app import DataBase, VehicleSnapshot
+
+# (description, sql, snapshot aggregate arguments)
+PATTERNS = (
+    ('count per brand', 'SELECT brand, COUNT(*) FROM vehicles GROUP BY brand', (('brand',), None, 'count')),
+    ('count per type, fuel', 'SELECT type, fuel, COUNT(*) FROM vehicles GROUP BY type, fuel', (('type', 'fuel'), None, 'count')),
+    ('count per color', 'SELECT color, COUNT(*) FROM vehicles GROUP BY color', (('color',), None, 'count')),
+    ('avg price per brand', 'SELECT brand, AVG(price) FROM vehicles GROUP BY brand', (('brand',), 'price', 'mean')),
+    ('avg price per type, status', 'SELECT type, status, AVG(price) FROM vehicles GROUP BY type, status', (('type', 'status'), 'price', 'mean')),
+    ('max engine per brand', 'SELECT brand, MAX(engine) FROM vehicles GROUP BY brand', (('brand',), 'engine', 'max')),
+    ('count per date, type', 'SELECT date, type, COUNT(*) FROM vehicles GROUP BY date, type', (('date', 'type'), None, 'count')),
+)
+
+
+def fill(db, rows, seed=0):
+    # repeats the sample vehicles with some noise, without the per row summary triggers
+    random.seed(seed)
+    sample = [row[1:] for row in db.get_all()]
+    with db.pool.connection() as con:
+        with con:
+            for trigger in ('insert', 'delete', 'update'):
+                con.execute('DROP TRIGGER IF EXISTS vehicles_summary_{};'.format(trigger))
+    batch = []
+    for _ in range(rows):
+        row = list(random.choice(sample))
+        row[13] = int(row[13] * random.uniform(0.5, 1.5))  # price
+        row[14] = '20{:02d}-{:02d}-{:02d}'.format(random.randint(15, 23), random.randint(1, 12), random.randint(1, 28))
+        batch.append(row)
+        if len(batch) == 50000:
+            db.insert_rows(batch)
+            batch = []
+    if batch:
+        db.insert_rows(batch)
+    db.rebuild_summaries()
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000, help='vehicles to generate')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'bench.db')
+        shutil.copy(os.path.join(os.path.dirname(__file__), '..', 'database.db'), db_file)
+        db = DataBase(db_file)
+        fill(db, args.rows)
+
+        start = time.perf_counter()
+        snapshot = VehicleSnapshot(db)
+        print('snapshot of {} rows loaded in {:.2f}s'.format(snapshot.size, time.perf_counter() - start))
+        for column, size in sorted(snapshot.memory_usage().items()):
+            print('  {:<18} {:10.1f} KiB'.format(column, size / 1024))
+
+        with db.pool.connection() as con:
+            print('{:<28} {:>10} {:>10} {:>8}'.format('pattern', 'sql ms', 'snap ms', 'speedup'))
+            for name, sql, (by, value, how) in PATTERNS:
+                sql_time = best_of(lambda: con.execute(sql).fetchall(), args.repeat)
+                snap_time = best_of(lambda: snapshot.aggregate(by, value, how), args.repeat)
+                print('{:<28} {:10.2f} {:10.2f} {:7.1f}x'.format(name, sql_time * 1e3, snap_time * 1e3, sql_time / snap_time))
+
+        # the km per manufacture year scatter: every row against the per brand sample
+        columns = ('brand', 'model', 'manufacture_year', 'kilometers', 'price')
+        frame_time = best_of(lambda: snapshot.frame(columns), args.repeat)
+        sample_time = best_of(lambda: snapshot.sample(columns, 5000, 'brand'), args.repeat)
+        print('{:<28} {:>10} {:10.2f} ({} rows)'.format('scatter frame', '', frame_time * 1e3, snapshot.size))
+        print('{:<28} {:>10} {:10.2f} ({} rows)'.format('scatter sample', '', sample_time * 1e3, len(snapshot.sample(columns, 5000, 'brand')[0])))
+        db.pool.close()
+
+
+if __name__ == '__main__':
+    main()
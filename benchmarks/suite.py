@@ -0,0 +1,205 @@
+"""Times every DataBase method and chart figure body on synthetic data and compares with a stored baseline.
+
+Run from the repository root:
+    python -m benchmarks.suite --rows 10k                      # writes benchmarks/results-10k.json, compares to the baseline
+    python -m benchmarks.suite --rows 1m --db /tmp/vehicles-1m.db   # reuses (or builds) a generated database
+    python -m benchmarks.suite --rows 10k --update-baseline    # stores the results as the new baseline
+
+    python -m benchmarks.suite --rows 10k --audit              # also checks the query plan of every statement
+
+Exits with 1 when a benchmark is slower than its baseline by more than --tolerance, or with --audit, when a
+statement scans vehicles or sorts its rows with a temp b-tree and doesn't match a pattern of benchmarks/audit-allow.json,
+the deliberate full reads. The audit covers the statements of the summary and change log triggers as well, with their
+OLD and NEW columns as parameters.
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+
+from app import Carly
+from benchmarks import synthetic
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# statement shape pattern -> why it reads every vehicle
+AUDIT_ALLOWLIST = os.path.join(HERE, 'audit-allow.json')
+
+
+def database_benchmarks(db):
+    # (name, callable) for every public DataBase method, each call leaves the database as it found it
+    first, last = db.get_min_of('date'), db.get_max_of('date')
+    vehicle = db.get_page(0, 1)[0]
+    new = (None,) + tuple(vehicle[1:15]) + (None,)
+
+    def add_and_delete():
+        vehicle_id = db.add_row(new)
+        db.delete_row((vehicle_id,))
+
+    def insert_and_delete():
+        db.insert_rows([new[1:15] + (last,)] * 1000)
+        with db.pool.connection() as con:
+            with con:
+                con.execute('DELETE FROM vehicles WHERE id > ?;', (db.get_max_of('id') - 1000,))
+
+    def apply_changes():
+        db.apply_changes(add_rows=[new])
+        db.apply_changes(delete_rows=[(db.get_max_of('id'),)])
+
+    return [
+        ('get_all', db.get_all),
+        ('count_field brand', lambda: db.count_field('brand')),
+        ('count_field brand, type', lambda: db.count_field('brand, type')),
+        ('count_field model (no summary)', lambda: db.count_field('model, color')),
+        ('summary kilometers', lambda: db.summary('kilometers')),
+        ('aggregates', db.aggregates),
+        ('histogram price', lambda: db.histogram('price')),
+        ('count_per_period Week', lambda: db.count_per_period('Week', first, last)),
+        ('count_per_period Month', lambda: db.count_per_period('Month', first, last)),
+        ('get_min_of date', lambda: db.get_min_of('date')),
+        ('get_max_of price', lambda: db.get_max_of('price')),
+        ('find_similar', lambda: db.find_similar(vehicle)),
+        ('count_rows', db.count_rows),
+        ('count_rows filtered', lambda: db.count_rows('{Brand} = BMW and {Price} > 10000')),
+        ('get_page first', lambda: db.get_page(0, 25)),
+        ('get_page sorted deep', lambda: db.get_page(1000, 25, '', [{'column_id': 'Price', 'direction': 'desc'}])),
+        ('get_page filtered', lambda: db.get_page(0, 25, '{Color} = red', [{'column_id': 'Kilometers', 'direction': 'asc'}])),
+        ('iter_rows first chunk', lambda: next(db.iter_rows())),
+        ('parse_filter', lambda: db.parse_filter('{Brand} = BMW and ({Price} > 10000 or {Fuel} = Diesel)')),
+        ('data_version', db.data_version),
+        ('scope_version', lambda: db.scope_version('type = ?', ['Car'])),
+        ('changes_since', lambda: db.changes_since(0)),
+        ('check_summaries', db.check_summaries),
+        ('add_row + delete_row', add_and_delete),
+        ('apply_changes', apply_changes),
+        ('insert_rows 1000', insert_and_delete),
+    ]
+
+
+def figure_benchmarks(web, db):
+    # (name, callable) for every chart figure body, without the figure cache
+    first, last = db.get_min_of('date'), db.get_max_of('date')
+    arguments = {
+        'count_per_freq': [('Day', first, last), ('Month', first, last)],
+        'count_rangeslider': [(None,), ((first, first[:4] + '-12-31'),)],
+        'count_per_typefuel': [()],
+        'km_per_manyear': [('All',), ('Car',)],
+        'count_per_pricerange': [()],
+        'avg_price_per_typestatus': [()],
+        'avg_price_per_brand': [('All',)],
+        'max_engine_per_brand': [()],
+        'count_per_color': [()],
+        'count_per_field': [('All', 'Brand'), ('All', 'Kilometers'), ('Car', 'Date Added')],
+    }
+    missing = set(web.figure_builders) - set(arguments)
+    if missing:
+        raise SystemExit('no benchmark arguments for {}'.format(', '.join(sorted(missing))))
+    return [('{}{}'.format(name, args), lambda name=name, args=args: web.figure_json(web.figure_builders[name](*args)))
+            for name, calls in arguments.items() for args in calls]
+
+
+def measure(func, repeat, clear):
+    # best of `repeat` cold calls, the query caches are emptied before each one
+    timings = []
+    for _ in range(repeat):
+        clear()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def compare(results, baseline, tolerance):
+    # benchmarks slower than (1 + tolerance) times their baseline, ignoring ones under a millisecond
+    regressions = []
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is not None and seconds > before * (1 + tolerance) and seconds - before > 1e-3:
+            regressions.append((name, before, seconds))
+    return regressions
+
+
+def unexpected_plans(flagged, allowlist):
+    # flagged statements that match no allowlist pattern
+    return sorted(statement for statement in flagged if not any(re.fullmatch(pattern, statement) for pattern in allowlist))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='10k', help='number of vehicles or one of {}'.format(', '.join(synthetic.SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help='generated database to reuse, built there if missing (default: a temporary one)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='results file (default: benchmarks/results-<rows>.json)')
+    parser.add_argument('--baseline', help='baseline file (default: benchmarks/baseline-<rows>.json)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown against the baseline')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--only', help='run the benchmarks whose name contains this')
+    parser.add_argument('--audit', action='store_true', help='EXPLAIN QUERY PLAN every statement (the first call of each is slower)')
+    args = parser.parse_args()
+
+    rows = synthetic.SIZES.get(args.rows.lower()) or int(args.rows)
+    label = args.rows.lower()
+    output = args.output or os.path.join(HERE, 'results-{}.json'.format(label))
+    baseline_file = args.baseline or os.path.join(HERE, 'baseline-{}.json'.format(label))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.abspath(args.db or os.path.join(tmp, 'bench.db'))
+        if not os.path.exists(db_file):
+            start = time.perf_counter()
+            synthetic.build(db_file, rows, args.seed).pool.close()
+            print('generated {} vehicles in {:.1f}s'.format(rows, time.perf_counter() - start), file=sys.stderr)
+
+        web = Carly(title='benchmark', db_file=db_file, audit_queries=args.audit)
+        db = web.db
+
+        def clear():
+            db.cache.clear()
+            web.figure_cache.clear()
+
+        results = {}
+        for group, benchmarks in (('db', database_benchmarks(db)), ('figure', figure_benchmarks(web, db))):
+            for name, func in benchmarks:
+                name = '{}: {}'.format(group, name)
+                if args.only and args.only not in name:
+                    continue
+                results[name] = measure(func, args.repeat, clear)
+                print('{:<60} {:10.2f} ms'.format(name, results[name] * 1e3), file=sys.stderr)
+        db.pool.close()
+
+    report = {'rows': rows, 'seed': args.seed, 'repeat': args.repeat, 'python': platform.python_version(),
+              'machine': platform.machine(), 'results': results}
+    slow_plans = []
+    if args.audit:
+        report['flagged_plans'] = dict(web.auditor.flagged)
+        print(web.auditor.report(), file=sys.stderr)
+        with open(AUDIT_ALLOWLIST) as f:
+            slow_plans = unexpected_plans(report['flagged_plans'], json.load(f))
+        for statement in slow_plans:
+            print('SLOW PLAN {}\n    {}'.format(statement, '\n    '.join(report['flagged_plans'][statement])))
+        print('{} statements scan vehicles or sort its rows with a temp b-tree and are not in {}'.format(len(slow_plans), AUDIT_ALLOWLIST))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+
+    if args.update_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print('baseline written to {}'.format(baseline_file))
+        return 1 if slow_plans else 0
+    if not os.path.exists(baseline_file):
+        print('no baseline at {}, run with --update-baseline to store one'.format(baseline_file))
+        return 1 if slow_plans else 0
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for name, before, after in regressions:
+        print('REGRESSION {:<50} {:10.2f} ms -> {:10.2f} ms ({:+.0f}%)'.format(name, before * 1e3, after * 1e3, (after / before - 1) * 100))
+    print('{} benchmarks, {} regressions against {}'.format(len(results), len(regressions), baseline_file))
+    return 1 if regressions or slow_plans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
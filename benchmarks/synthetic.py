@@ -0,0 +1,105 @@
+"""Seeded synthetic vehicles following the vehicles schema, for benchmarks at production-like sizes.
+
+Type, brand, model, engine and hp are drawn together from the rows of assets/vehicles.csv, so every
+model keeps its real brand and engine. Colors and fuels follow their frequencies in that file per type,
+the manufacture year, kilometers, price and date added are drawn per row.
+
+Run from the repository root:  python -m benchmarks.synthetic --rows 1000000 --out /tmp/vehicles-1m.db
+"""
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from app import DataBase
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+
+def vehicles(rows, seed=0, first_date='2015-01-01', last_date='2024-12-31'):
+    # DataFrame of `rows` vehicles with the vehicles columns except id
+    rng = np.random.default_rng(seed)
+    sample = pd.read_csv(os.path.join(ROOT, 'assets', 'vehicles.csv'))
+    # a few more cars than the sample, which is mostly motorbikes
+    weights = np.where(sample['type'] == 'Car', 2.0, 1.0)
+    template = sample.iloc[rng.choice(len(sample), rows, p=weights / weights.sum())].reset_index(drop=True)
+    car = (template['type'] == 'Car').to_numpy()
+
+    def frequencies(column):
+        # draws column values per type with the sample's frequencies of that type
+        values = np.empty(rows, dtype=object)
+        for is_car in (True, False):
+            counts = sample.loc[(sample['type'] == 'Car') == is_car, column].value_counts()
+            values[car == is_car] = rng.choice(counts.index.to_numpy(), int((car == is_car).sum()), p=(counts / counts.sum()).to_numpy())
+        return values
+
+    age = np.minimum(rng.gamma(2.0, 3.0, rows).astype(np.int64), 40)
+    year = 2024 - age
+    new = (age == 0) & (rng.random(rows) < 0.7)
+    kilometers = np.where(new, 0, (age + rng.random(rows)) * rng.lognormal(np.log(np.where(car, 14000, 5000)), 0.5, rows))
+    # list price of the model in the sample, depreciated with age and mileage
+    price = template['price'].to_numpy() * rng.lognormal(0, 0.15, rows) * 0.88 ** age * np.exp(-kilometers / 400000)
+    days = (np.datetime64(last_date) - np.datetime64(first_date)).astype(np.int64)
+    added = np.datetime64(first_date) + np.sort(rng.integers(0, days + 1, rows))
+
+    return pd.DataFrame({
+        'type': template['type'],
+        'brand': template['brand'],
+        'model': template['model'],
+        'color': frequencies('color'),
+        'fuel': frequencies('fuel'),
+        'engine': template['engine'],
+        'hp': template['hp'],
+        'doors': np.where(car, rng.choice([3, 5], rows, p=[0.15, 0.85]), None),
+        'sunroof': np.where(car, np.where(rng.random(rows) < 0.15, 'True', 'False'), None),
+        'cases': np.where(car, None, rng.choice([0, 1, 2, 3], rows, p=[0.6, 0.25, 0.1, 0.05])),
+        'manufacture_year': year,
+        'status': np.where(new, 'New', 'Used'),
+        'kilometers': (np.round(kilometers / 1000) * 1000).astype(np.int64),
+        'price': (np.round(price / 100) * 100).astype(np.int64),
+        'date': added.astype(str),
+    })
+
+
+def fill(db, rows, seed=0, chunk_size=100000):
+    # replaces the vehicles with `rows` synthetic ones, the summaries are rebuilt once at the end
+    with db.pool.connection() as con:
+        with con:
+            for trigger in ('insert', 'delete', 'update'):
+                con.execute('DROP TRIGGER IF EXISTS vehicles_summary_{};'.format(trigger))
+            con.execute('DELETE FROM vehicles;')
+    for start in range(0, rows, chunk_size):
+        chunk = vehicles(min(chunk_size, rows - start), seed=(seed, start))
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        db.insert_rows([tuple(row) for row in chunk.itertuples(index=False)])
+    db.rebuild_summaries()
+    with db.pool.connection() as con:
+        con.execute('ANALYZE vehicles;')
+
+
+def build(path, rows, seed=0) -> DataBase:
+    # a copy of database.db (users, schema) with `rows` synthetic vehicles
+    shutil.copy(os.path.join(ROOT, 'database.db'), path)
+    db = DataBase(path)
+    fill(db, rows, seed)
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', default='10k', help='number of vehicles or one of {}'.format(', '.join(SIZES)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', required=True, help='database file to write')
+    args = parser.parse_args()
+
+    rows = SIZES.get(args.rows.lower()) or int(args.rows)
+    db = build(os.path.abspath(args.out), rows, args.seed)
+    print('{} vehicles written to {}'.format(db.count_rows(), args.out))
+    db.pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Load test of the field explorer chart callback against gunicorn with 1, 2, 4, ... workers.
+
+Needs gunicorn. Run from the repository root:  python -m benchmarks.workers [--workers 1 2 4] [--clients 16] [--seconds 10] [--cold]
+
+Every client logs in once (session cookie) and then posts callback requests in a loop,
+--cold touches a vehicle of the requested type before every request, so each one rebuilds its figure
+(the write is timed with the request).
+"""
+import argparse
+import http.cookiejar
+import itertools
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FIELDS = ('Brand', 'Color', 'Fuel', 'Engine', 'HP', 'Manufacture Year', 'Status', 'Kilometers', 'Price')
+
+
+def callback(outputs, inputs, state=()):
+    # request body of POST /_dash-update-component
+    return {
+        'output': '..{}..'.format('...'.join('{}.{}'.format(i, p) for i, p in outputs)),
+        'outputs': [{'id': i, 'property': p} for i, p in outputs],
+        'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+        'state': [{'id': i, 'property': p, 'value': v} for i, p, v in state],
+        'changedPropIds': ['{}.{}'.format(inputs[0][0], inputs[0][1])],
+    }
+
+
+def post(opener, url, body):
+    request = urllib.request.Request(url + '/_dash-update-component', json.dumps(body).encode(),
+                                     {'Content-Type': 'application/json'})
+    with opener.open(request) as response:
+        return response.read()
+
+
+def client(url, deadline, db_file, counter, results):
+    # db_file: with --cold, the database to write to before each request
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    post(opener, url, callback((('user', 'data'), ('login-alert', 'is_open'), ('login-alert', 'children')),
+                               (('login-page-bttn', 'n_clicks', 1),),
+                               (('username', 'value', 'user'), ('password', 'value', 'password'))))
+    con = sqlite3.connect(db_file, timeout=30) if db_file else None
+    done = 0
+    while time.perf_counter() < deadline:
+        n = next(counter)
+        selected_type = ('All', 'Car', 'Motorbike')[n % 3]
+        if con:
+            # a write in the figure's scope, the cached figure is stale in every worker
+            con.execute('UPDATE vehicles SET price = price WHERE id = (SELECT MIN(id) FROM vehicles WHERE type = ?);',
+                        ('Car' if selected_type == 'All' else selected_type,))
+            con.commit()
+        post(opener, url, callback(
+            (('count-per-typefield', 'figure'), ('count-per-typefield-version', 'data')),
+            (('type-radios3', 'value', selected_type), ('field-dropdown', 'value', FIELDS[n % len(FIELDS)]),
+             ('chart-tabs', 'value', 'tab10')),
+            (('count-per-typefield-version', 'data', None),)))
+        done += 1
+    if con:
+        con.close()
+    results.append(done)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(workers, db_file, args):
+    port = free_port()
+    url = 'http://127.0.0.1:{}'.format(port)
+    env = dict(os.environ, CARLY_DB=db_file)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', '127.0.0.1:{}'.format(port),
+                               '--log-level', 'warning', 'wsgi:server'], cwd=ROOT, env=env)
+    try:
+        for _ in range(600):
+            try:
+                urllib.request.urlopen(url + '/', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        results = []
+        counter = itertools.count()
+        deadline = time.perf_counter() + args.seconds
+        threads = [threading.Thread(target=client, args=(url, deadline, db_file if args.cold else None, counter, results)) for _ in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(results) / args.seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--cold', action='store_true', help='rebuild the figure on every request')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, 'bench.db')
+        shutil.copy(os.path.join(ROOT, 'database.db'), db_file)
+        print('{:>8} {:>10} {:>8}'.format('workers', 'req/s', 'scaling'))
+        base = None
+        for workers in args.workers:
+            throughput = run(workers, db_file, args)
+            if not throughput:
+                # every client failed, e.g. on the login request
+                raise SystemExit('no requests completed with {} workers'.format(workers))
+            base = base or throughput
+            print('{:>8} {:10.1f} {:7.2f}x'.format(workers, throughput, throughput / base))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,569 @@
+# run from the repository root:  python -m pytest tests
+import base64
+import gzip
+import json
+import random
+import sqlite3
+from datetime import date, timedelta
+
+import bcrypt
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import Carly, ConnectionPool, DataBase, Metrics, QueryAuditor, UserDB, VehicleSnapshot
+from benchmarks.suite import AUDIT_ALLOWLIST, unexpected_plans
+
+
+@pytest.fixture
+def db(tmp_path):
+    # a new database file, filled from assets/vehicles.csv and migrated
+    db = DataBase(str(tmp_path / 'test.db'))
+    yield db
+    db.pool.close()
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('', ('', [])),
+    ('{Engine} > 1500 and {Brand} contains "Ford"', ('("engine" > ? AND instr("brand", ?) > 0)', [1500, 'Ford'])),
+    ('{Price} ge 10000.5', ('"price" >= ?', [10000.5])),
+    ('{Color} i= Red', ('"color" = ? COLLATE NOCASE', ['Red'])),
+    ('{Color} s!= red', ('"color" != ?', ['red'])),
+    ('{Model} icontains "50%_a"', ('"model" LIKE ? ESCAPE \'\\\'', ['%50\\%\\_a%'])),
+    ('{Model} = "Focus \\"ST\\""', ('"model" = ?', ['Focus "ST"'])),
+    ("{Model} = 'Focus ST'", ('"model" = ?', ['Focus ST'])),
+    ('{Model} = `Focus ST`', ('"model" = ?', ['Focus ST'])),
+    ('{Date Added} datestartswith 2021', ('instr("date", ?) = 1', ['2021'])),
+    ('{Doors} is nil', ('"doors" IS NULL', [])),
+    ('{Brand} is blank', ('("brand" IS NULL OR "brand" = \'\')', [])),
+    ('!({Type} = Car) || {Price} < 5000', ('(NOT ("type" = ?) OR "price" < ?)', ['Car', 5000])),
+    ('{Type} = Car && ({Fuel} = Diesel or {Fuel} = Petrol)',
+     ('("type" = ? AND ("fuel" = ? OR "fuel" = ?))', ['Car', 'Diesel', 'Petrol'])),
+    ('(({Price} > 5))', ('"price" > ?', [5])),
+])
+def test_parse_filter(db, query, expected):
+    assert db.parse_filter(query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    '{Owner} = me',
+    '{Price} ~ 5',
+    '{Price} is big',
+    '({Price} > 5',
+    '{Price} > 5 {Brand}',
+    '{Price} >',
+    'Price > 5',
+])
+def test_parse_filter_rejects(db, query):
+    with pytest.raises(ValueError):
+        db.parse_filter(query)
+
+
+def test_parse_filter_runs(db):
+    with db.pool.connection() as con:
+        expected = con.execute('SELECT COUNT(*) FROM vehicles WHERE brand = ? AND price > ?;', ('Ford', 10000)).fetchone()[0]
+    assert db.count_rows('{Brand} = Ford and {Price} > 10000') == expected > 0
+
+
+def test_pool_exhausted(tmp_path):
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, timeout=0.1)
+    with pool.connection():
+        with pytest.raises(sqlite3.OperationalError, match='connection pool exhausted'):
+            pool.acquire()
+    # the connection went back to the pool
+    with pool.connection() as con:
+        assert con.execute('SELECT 1;').fetchone() == (1,)
+    pool.close()
+
+
+def test_iter_rows_outside_pool(db):
+    idle, opened = db.pool.idle.qsize(), db.pool.opened
+    rows = db.iter_rows(chunk_size=10)
+    assert len(next(rows)) == 10
+    # mid-download, every pooled connection is still free for the callbacks
+    assert (db.pool.idle.qsize(), db.pool.opened) == (idle, opened)
+    rows.close()
+
+
+def test_summaries_follow_writes(db):
+    # whatever the mix of writes, the triggers leave vehicle_summary equal to a rebuild from the raw table
+    rng = random.Random(0)
+    columns = db.columns[1:]
+    with db.pool.connection() as con:
+        rows = con.execute('SELECT {} FROM vehicles;'.format(', '.join(columns))).fetchall()
+        ids = [row[0] for row in con.execute('SELECT id FROM vehicles;')]
+        for _ in range(500):
+            action = rng.choice(('insert', 'update', 'delete'))
+            if action == 'insert':
+                cur = con.execute('INSERT INTO vehicles ({}) VALUES ({});'.format(', '.join(columns), ', '.join('?' * len(columns))),
+                                  rng.choice(rows))
+                ids.append(cur.lastrowid)
+            elif action == 'update':
+                column = rng.choice(('brand', 'color', 'fuel', 'status', 'type', 'price', 'engine'))
+                value = rng.choice(rows)[columns.index(column)]
+                if column in ('price', 'engine') and rng.random() < 0.2:
+                    value = None
+                con.execute('UPDATE vehicles SET "{}" = ? WHERE id = ?;'.format(column), (value, rng.choice(ids)))
+            else:
+                con.execute('DELETE FROM vehicles WHERE id = ?;', (ids.pop(rng.randrange(len(ids))),))
+        con.commit()
+    assert db.check_summaries() == []
+
+
+def test_price_range_dropped(db):
+    # installed by migration 3, dropped by migration 8 with its rows and trigger statements
+    assert 'price_range' not in db.summary_dims
+    with db.pool.connection() as con:
+        assert con.execute("SELECT COUNT(*) FROM vehicle_summary WHERE dim = 'price_range';").fetchone()[0] == 0
+        assert not con.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND sql LIKE '%price_range%';").fetchall()
+
+
+def test_normalize_chunk(db):
+    columns = ('type', 'brand', 'model', 'color', 'fuel', 'engine', 'hp', 'doors', 'sunroof', 'cases',
+               'manufacture_year', 'status', 'kilometers', 'price', 'date')
+    car = ('car', ' Ford ', 'Focus', 'Grey', 'Diesel', '1500', '120', '5', 'yes', '2', '2017', 'used', '146000', '13000', '')
+    moto = ('Motorbike', 'Honda', 'CB500', 'red', 'Petrol', '471', '47', '', '', '1', '2019', 'New', '0', '6000', '2021-10-30')
+    changes = [
+        ('type', 'Truck', 'invalid type'),
+        ('brand', '', 'missing text field'),
+        ('status', 'Broken', 'invalid status'),
+        ('price', 'abc', 'missing or non-numeric number field'),
+        ('kilometers', '-5', 'negative number'),
+        ('engine', '1500.5', 'non-integer number'),
+        ('doors', '', 'car without doors or sunroof'),
+        ('sunroof', 'maybe', 'car without doors or sunroof'),
+        ('date', 'not a date', 'invalid date'),
+    ]
+    rows = [car, moto] + [tuple(value if c == column else v for c, v in zip(columns, car)) for column, value, _ in changes]
+    rows.append(tuple('' if c == 'cases' else v for c, v in zip(columns, moto)))
+    chunk = pd.DataFrame(rows, columns=columns, dtype=str).replace('', np.nan)
+
+    clean, rejected = db.normalize_chunk(chunk)
+    # lines of the csv: the header is line 1
+    assert rejected == [(line + 4, reason) for line, (_, _, reason) in enumerate(changes)] + [(len(rows) + 1, 'motorbike without cases')]
+    assert clean == [
+        ('Car', 'Ford', 'Focus', 'grey', 'Diesel', 1500, 120, 5, 'True', None, 2017, 'Used', 146000, 13000, date.today().isoformat()),
+        ('Motorbike', 'Honda', 'CB500', 'red', 'Petrol', 471, 47, None, None, 1, 2019, 'New', 0, 6000, '2021-10-30'),
+    ]
+
+
+def test_normalize_chunk_missing_columns(db):
+    with pytest.raises(ValueError, match='Missing columns: price'):
+        db.normalize_chunk(pd.DataFrame({c: [] for c in db.columns if c not in ('id', 'price')}, dtype=str))
+
+
+def test_scope_version(db):
+    def write(sql, params=()):
+        with db.pool.connection() as con:
+            con.execute(sql, params)
+            con.commit()
+
+    motorbikes = db.scope_version('type = ?', ('Motorbike',))
+    cars = db.scope_version('type = ?', ('Car',))
+    with db.pool.connection() as con:
+        car_id = con.execute("SELECT id FROM vehicles WHERE type = 'Car' LIMIT 1;").fetchone()[0]
+
+    # writes outside the scope leave its version alone
+    write('UPDATE vehicles SET price = price + 1 WHERE id = ?;', (car_id,))
+    assert db.scope_version('type = ?', ('Motorbike',)) == motorbikes
+    assert db.scope_version('type = ?', ('Car',)) > cars
+
+    # a row moving into the scope, or leaving it, is a write inside it
+    write("UPDATE vehicles SET type = 'Motorbike' WHERE id = ?;", (car_id,))
+    assert db.scope_version('type = ?', ('Motorbike',)) > motorbikes
+    motorbikes = db.scope_version('type = ?', ('Motorbike',))
+    write('DELETE FROM vehicles WHERE id = ?;', (car_id,))
+    assert db.scope_version('type = ?', ('Motorbike',)) > motorbikes
+    assert db.scope_version() == db.scope_version('type = ?', ('Motorbike',))
+
+
+def live_ids(db):
+    with db.pool.connection() as con:
+        return sorted(row[0] for row in con.execute('SELECT id FROM vehicles;'))
+
+
+def test_snapshot_tombstones(db):
+    snapshot = VehicleSnapshot(db)
+    size = snapshot.size
+    vehicle_id = live_ids(db)[0]
+    row = snapshot.rows[vehicle_id]
+    db.delete_row((vehicle_id,))
+    new_id = db.add_row((None,) + tuple(db.get_page(0, 1)[0][1:15]) + (None,))
+
+    snapshot.refresh()
+    # the deleted vehicle stays in the arrays, marked dead, until the next compaction
+    assert vehicle_id not in snapshot.rows
+    assert not snapshot.arrays['alive'][row]
+    assert snapshot.deleted == 1
+    assert snapshot.size == size + 1
+    assert snapshot.arrays['id'][snapshot.rows[new_id]] == new_id
+    assert sorted(snapshot.rows) == live_ids(db)
+    assert sum(count for _, count in snapshot.aggregate(['type'])) == db.count_rows()
+
+
+def test_snapshot_compaction(db):
+    vehicle = tuple(db.get_page(0, 1)[0][1:])
+    db.insert_rows([vehicle] * 2000)
+    snapshot = VehicleSnapshot(db)
+    size = snapshot.size
+    counts = dict(((t, b), c) for t, b, c in snapshot.aggregate(['type', 'brand']))
+
+    added = live_ids(db)[-2000:]
+    db.apply_changes(delete_rows=[(vehicle_id,) for vehicle_id in added[:1500]])
+    snapshot.refresh()
+
+    # once more than 1024 and a quarter of the rows are dead, the arrays are rebuilt with the live rows,
+    # the deletes after that are tombstones again
+    assert snapshot.size < size - 1024
+    assert snapshot.size - snapshot.deleted == snapshot.arrays['alive'][:snapshot.size].sum() == db.count_rows()
+
+    snapshot.compact()
+    assert snapshot.deleted == 0
+    assert snapshot.size == snapshot.capacity == db.count_rows()
+    assert snapshot.arrays['alive'].all()
+    assert sorted(snapshot.rows) == live_ids(db)
+    assert all(snapshot.arrays['id'][row] == vehicle_id for vehicle_id, row in snapshot.rows.items())
+    counts[(vehicle[0], vehicle[1])] -= 1500
+    assert dict(((t, b), c) for t, b, c in snapshot.aggregate(['type', 'brand'])) == counts
+
+
+def test_aggregates_match_sql(db):
+    with db.pool.connection() as con:
+        # vehicles without a price count as vehicles but stay out of the average price
+        con.execute('UPDATE vehicles SET price = NULL WHERE id % 7 = 0;')
+        con.commit()
+    aggregates = db.aggregates()
+    with db.pool.connection() as con:
+        for dim in ('fuel', 'color', 'status', 'brand'):
+            expected = con.execute('SELECT {0}, COUNT(*), AVG(price), MAX(engine) FROM vehicles GROUP BY {0} ORDER BY {0};'.format(dim)).fetchall()
+            rows = aggregates[dim]['all']
+            assert [(value, count) for value, count, _, _, _ in rows] == [(value, count) for value, count, _, _ in expected]
+            assert [price_sum / price_count if price_count else None for _, _, price_count, price_sum, _ in rows] == pytest.approx([avg for _, _, avg, _ in expected])
+        assert [engine_max for _, _, _, _, engine_max in aggregates['brand']['all']] == [engine for _, _, _, engine in expected]
+
+        expected = con.execute('SELECT brand, type, COUNT(*), AVG(price) FROM vehicles GROUP BY brand, type ORDER BY brand, type;').fetchall()
+    rows = aggregates['brand']['by_type']
+    assert [row[:3] for row in rows] == [row[:3] for row in expected]
+    assert [price_sum / price_count if price_count else None for _, _, _, price_count, price_sum, _ in rows] == pytest.approx([avg for _, _, _, avg in expected])
+    assert db.check_summaries() == []
+
+
+def test_bin_edges_single_value():
+    assert DataBase.bin_edges(np.array([5.0, 5.0]), np.array([1.0, 3.0]), 10).tolist() == [5.0, 6.0]
+
+
+@pytest.mark.parametrize('low, high, bins', [(0, 99999, 10), (1234, 98765, 40), (0.3, 7.9, 5), (1990, 2024, 40)])
+def test_bin_edges_fd(low, high, bins):
+    values = np.linspace(low, high, 500)
+    edges = DataBase.bin_edges(values, np.ones(500), bins)
+    step = edges[1] - edges[0]
+    assert 1 <= len(edges) - 1 <= bins
+    assert edges[0] <= low and edges[-1] >= high
+    assert np.allclose(np.diff(edges), step)
+    # a round step: 1, 2, 2.5 or 5 times a power of ten, and edges on its multiples
+    assert round(step / 10 ** np.floor(np.log10(step)), 6) in (1, 2, 2.5, 5)
+    assert np.isclose(edges[0] / step, round(edges[0] / step))
+
+
+def test_bin_edges_quantile():
+    values = np.array([1.0, 2.0, 3.0, 4.0, 100.0])
+    weights = np.array([100.0, 100.0, 100.0, 100.0, 1.0])
+    edges = DataBase.bin_edges(values, weights, 4, method='quantile')
+    assert edges[0] == 1 and edges[-1] == 100
+    assert (np.diff(edges) > 0).all() and len(edges) - 1 <= 4
+    # most of the weight is below 4, so are all the inner edges
+    assert (edges[1:-1] <= 4).all()
+
+
+@pytest.mark.parametrize('period, bucket', [
+    ('Day', 'date'),
+    ('Week', "date(date, 'weekday 0', '-6 days')"),
+    ('Month', "strftime('%Y-%m-01', date)"),
+    ('Year', "strftime('%Y-01-01', date)"),
+])
+def test_count_per_period(db, period, bucket):
+    rng = random.Random(period)
+    with db.pool.connection() as con:
+        rows = con.execute('SELECT {} FROM vehicles;'.format(', '.join(db.columns[1:-1]))).fetchall()
+        con.executemany('INSERT INTO vehicles ({}) VALUES ({});'.format(', '.join(db.columns[1:]), ', '.join('?' * (len(db.columns) - 1))),
+                        [rng.choice(rows) + ((date(2019, 1, 1) + timedelta(days=rng.randrange(1200))).isoformat(),) for _ in range(2000)])
+        con.commit()
+
+    for start, end in [('2019-01-01', '2022-12-31'), ('2019-03-13', '2021-08-02'), ('2020-02-29', '2020-03-01'), ('2020-06-10', '2020-06-10')]:
+        with db.pool.connection() as con:
+            expected = con.execute('''SELECT {0} AS freq, type, COUNT(*), SUM(COUNT(*)) OVER (PARTITION BY {0}) FROM vehicles
+                WHERE date >= ? AND date <= ? GROUP BY freq, type ORDER BY freq, type;'''.format(bucket), (start, end)).fetchall()
+        assert sorted(db.count_per_period(period, start, end)) == expected
+
+
+def test_downsample_short_series():
+    assert Carly.downsample(np.arange(10), np.arange(10), 20).tolist() == list(range(10))
+    assert Carly.downsample(np.arange(10), np.arange(10), 2).tolist() == list(range(10))
+
+
+def test_downsample():
+    rng = np.random.default_rng(0)
+    x = np.sort(rng.random(1000))
+    y = rng.random(1000)
+    keep = Carly.downsample(x, y, 50)
+    assert len(keep) == 50
+    assert keep[0] == 0 and keep[-1] == 999
+    assert (np.diff(keep) > 0).all()
+
+
+def test_downsample_keeps_peaks():
+    y = np.zeros(1000)
+    y[123], y[700] = 100, -100
+    keep = Carly.downsample(np.arange(1000), y, 20)
+    assert 123 in keep and 700 in keep
+
+
+@pytest.fixture
+def web(tmp_path):
+    web = Carly('Carly', str(tmp_path / 'test.db'))
+    yield web
+    web.db.pool.close()
+
+
+def post_callback(client, output, outputs, inputs, state=()):
+    return client.post('/_dash-update-component', json={
+        'output': output,
+        'outputs': outputs,
+        'inputs': inputs,
+        'state': list(state),
+        'changedPropIds': ['{id}.{property}'.format(**inputs[0])],
+    })
+
+
+def test_login_guard(web):
+    client = web.app.server.test_client()
+    field_options = ('..field-dropdown.options...field-dropdown.value..',
+                     [{'id': 'field-dropdown', 'property': 'options'}, {'id': 'field-dropdown', 'property': 'value'}],
+                     [{'id': 'type-radios3', 'property': 'value', 'value': 'Car'}])
+    home = ('page-content.children', {'id': 'page-content', 'property': 'children'}, [{'id': 'url', 'property': 'pathname', 'value': '/'}])
+
+    # only the login and page routing callbacks run without a session user
+    assert post_callback(client, *field_options).status_code == 403
+    assert post_callback(client, *home).status_code == 200
+
+    with client.session_transaction() as session:
+        session['user'] = 'admin'
+    response = post_callback(client, *field_options)
+    assert response.status_code == 200
+    assert response.get_json()['response']['field-dropdown']['value'] == 'Brand'
+
+
+@pytest.fixture
+def users(tmp_path):
+    users = UserDB(str(tmp_path / 'users.db'), rounds=4, max_attempts=3)
+    yield users
+    users.verifier.shutdown()
+    users.pool.close()
+
+
+def test_outputs_follow_their_scope(web):
+    client = web.app.server.test_client()
+    with client.session_transaction() as session:
+        session['user'] = 'admin'
+
+    def motorbike_chart():
+        response = post_callback(client, '..count-per-typefield.figure...count-per-typefield-version.data..',
+                                 [{'id': 'count-per-typefield', 'property': 'figure'}, {'id': 'count-per-typefield-version', 'property': 'data'}],
+                                 [{'id': 'type-radios3', 'property': 'value', 'value': 'Motorbike'},
+                                  {'id': 'field-dropdown', 'property': 'value', 'value': 'Brand'},
+                                  {'id': 'chart-tabs', 'property': 'value', 'value': 'tab10'}],
+                                 [{'id': 'count-per-typefield-version', 'property': 'data', 'value': None}])
+        assert response.status_code == 200
+        return web.recomputes['computed']
+
+    def write(sql):
+        with web.db.pool.connection() as con:
+            con.execute(sql)
+            con.commit()
+
+    computed = motorbike_chart()
+    # a write to a car leaves the motorbike chart alone, a write to a motorbike rebuilds it
+    write("UPDATE vehicles SET price = price + 1 WHERE id = (SELECT MIN(id) FROM vehicles WHERE type = 'Car');")
+    assert motorbike_chart() == computed
+    assert web.recomputes['skipped'] == 1
+    write("UPDATE vehicles SET price = price + 1 WHERE id = (SELECT MIN(id) FROM vehicles WHERE type = 'Motorbike');")
+    assert motorbike_chart() == computed + 1
+
+    # the charts page starts the date picker at the first date, without a callback for it
+    picker = web.charts_layout()['my-date-picker-range']
+    assert picker.start_date == picker.min_date_allowed == web.db.get_min_of('date')
+
+
+def test_update_table(web):
+    client = web.app.server.test_client()
+    with client.session_transaction() as session:
+        session['user'] = 'admin'
+
+    def update_table(page_current, filter_query, changed):
+        values = {'page_current': page_current, 'page_size': 10, 'sort_by': [], 'filter_query': filter_query,
+                  'sort_action': 'custom', 'filter_action': 'custom'}
+        outputs = [('db-table', 'data'), ('db-table', 'page_count'), ('db-table', 'page_current'),
+                   ('filter-alert', 'children'), ('filter-alert', 'is_open')]
+        response = client.post('/_dash-update-component', json={
+            'output': '..{}..'.format('...'.join('{}.{}'.format(*o) for o in outputs)),
+            'outputs': [{'id': i, 'property': p} for i, p in outputs],
+            'inputs': [{'id': 'db-table', 'property': p, 'value': v} for p, v in values.items()],
+            'changedPropIds': ['db-table.{}'.format(changed)],
+        })
+        assert response.status_code == 200
+        return response.get_json()['response']
+
+    response = update_table(5, '', 'page_current')
+    assert 'page_current' not in response['db-table'] and len(response['db-table']['data']) == 10
+    # a new filter starts at the first page
+    response = update_table(5, '{Type} = Car', 'filter_query')
+    assert response['db-table']['page_current'] == 0
+    assert {row['Type'] for row in response['db-table']['data']} == {'Car'}
+    # past the last page of the filtered rows, the last page
+    pages = response['db-table']['page_count']
+    response = update_table(pages + 3, '{Type} = Car', 'page_current')
+    assert response['db-table']['page_current'] == pages - 1 and response['db-table']['data']
+    assert response['filter-alert'] == {'children': None, 'is_open': False}
+
+    # an invalid filter leaves the table as it is and says why
+    response = update_table(0, '{Owner} = me', 'filter_query')
+    assert 'db-table' not in response
+    assert response['filter-alert']['is_open'] and response['filter-alert']['children'].startswith('Invalid filter: ')
+
+
+@pytest.mark.parametrize('filename, data', [
+    ('vehicles.csv.gz', base64.b64encode(b'not gzip data')),
+    ('vehicles.csv.gz', base64.b64encode(gzip.compress(b'type,brand\n' + b'Car,Ford\n' * 1000, mtime=0)[:-30])),
+    ('vehicles.csv', b'bm90IGJhc2U2N'),
+])
+def test_import_upload_fails(web, filename, data):
+    client = web.app.server.test_client()
+    with client.session_transaction() as session:
+        session['user'] = 'admin'
+    count = web.db.count_rows()
+    response = client.post('/_dash-update-component', json={
+        'output': '..import-alert.children...import-alert.color...import-alert.is_open..',
+        'outputs': [{'id': 'import-alert', 'property': p} for p in ('children', 'color', 'is_open')],
+        'inputs': [{'id': 'import-upload', 'property': 'contents', 'value': 'data:application/octet-stream;base64,' + data.decode()}],
+        'state': [{'id': 'import-upload', 'property': 'filename', 'value': filename}],
+        'changedPropIds': ['import-upload.contents'],
+    })
+    # an alert instead of a server error
+    assert response.status_code == 200
+    alert = response.get_json()['response']['import-alert']
+    assert alert['color'] == 'danger' and alert['children'].startswith('Import of {} failed: '.format(filename))
+    assert web.db.count_rows() == count
+
+
+def test_login_throttled(users):
+    for _ in range(3):
+        assert not users.check_password('user', 'wrong')
+    # refused without checking the password, even a correct one, other usernames still log in
+    with pytest.raises(UserDB.Throttled):
+        users.check_password('user', 'password')
+    assert users.check_password('admin', 'stronger')
+
+
+def test_rehash(users):
+    stored = users.password_hash('user')
+    assert not users.needs_rehash(stored)
+
+    # another cost factor
+    users.rounds = 5
+    assert users.needs_rehash(stored)
+    users.rehash('user', 'password', stored)
+    rehashed = users.password_hash('user')
+    assert rehashed.startswith('$2b$05$') and bcrypt.checkpw(b'password', rehashed.encode())
+    assert not users.needs_rehash(rehashed)
+    # only replaces the hash it was computed from
+    users.rehash('user', 'other', stored)
+    assert users.password_hash('user') == rehashed
+
+    # a salt shared with another user
+    with users.pool.connection() as con:
+        con.execute("UPDATE users SET password = ? WHERE username = 'admin';", (bcrypt.hashpw(b'stronger', rehashed[:29].encode()).decode(),))
+        con.commit()
+    assert users.needs_rehash(rehashed)
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.observe('callback', 'update_table', 0.003, rows=20, size=512)
+    metrics.observe('callback', 'update_table', 0.2)
+    metrics.observe('sql', Metrics.statement("SELECT * FROM vehicles WHERE brand = 'Ford' LIMIT 10;"), 0.0005, rows=3)
+    lines = metrics.render().splitlines()
+
+    assert '# TYPE carly_callback_seconds histogram' in lines
+    assert 'carly_callback_seconds_bucket{callback="update_table",le="0.0025"} 0' in lines
+    assert 'carly_callback_seconds_bucket{callback="update_table",le="0.005"} 1' in lines
+    assert 'carly_callback_seconds_bucket{callback="update_table",le="+Inf"} 2' in lines
+    assert 'carly_callback_seconds_count{callback="update_table"} 2' in lines
+    assert 'carly_callback_rows_total{callback="update_table"} 20' in lines
+    assert 'carly_callback_response_bytes_total{callback="update_table"} 512' in lines
+    # one series per statement shape, the literals are replaced by ?
+    assert 'carly_sql_rows_total{statement="SELECT * FROM vehicles WHERE brand = ? LIMIT ?;"} 3' in lines
+    assert not any(line.startswith('carly_sql_response_bytes_total') for line in lines)
+
+
+def test_metrics_page(web):
+    client = web.app.server.test_client()
+    assert client.get('/metrics').status_code == 403
+    with client.session_transaction() as session:
+        session['user'] = 'admin'
+    post_callback(client, '..field-dropdown.options...field-dropdown.value..',
+                  [{'id': 'field-dropdown', 'property': 'options'}, {'id': 'field-dropdown', 'property': 'value'}],
+                  [{'id': 'type-radios3', 'property': 'value', 'value': 'Car'}])
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    lines = response.get_data(as_text=True).splitlines()
+    assert 'carly_callback_seconds_count{callback="set_field_options"} 1' in lines
+    assert any(line.startswith('carly_sql_seconds_count{statement="SELECT ') for line in lines)
+    assert any(line.startswith('carly_cache_requests_total{cache="figure",result="hit"} ') for line in lines)
+
+
+def test_query_auditor(db):
+    auditor = QueryAuditor()
+    with db.pool.connection() as con:
+        auditor.check(con, 'SELECT * FROM vehicles WHERE model = ?;', ('Focus',))
+        auditor.check(con, 'SELECT * FROM vehicles WHERE id = ?;', (1,))
+        auditor.check(con, 'SELECT type, brand, model FROM vehicles WHERE type = ? ORDER BY hp;', ('Car',))
+        auditor.check(con, 'SELECT * FROM vehicles WHERE id = 2;')
+
+    # no index on model: a full scan, and a sort of the matching rows, the lookup by id is fine
+    assert sorted(auditor.flagged) == ['SELECT * FROM vehicles WHERE model = ?;', 'SELECT type, brand, model FROM vehicles WHERE type = ? ORDER BY hp;']
+    assert any('SCAN' in line for line in auditor.flagged['SELECT * FROM vehicles WHERE model = ?;'])
+    # once per statement shape
+    assert len(auditor.seen) == 3
+    assert auditor.report().startswith('2 of 3 statements scan vehicles')
+
+
+def test_audit_allowlist(db):
+    with open(AUDIT_ALLOWLIST) as f:
+        allowlist = json.load(f)
+    auditor = QueryAuditor()
+    with db.pool.connection() as con:
+        auditor.check_triggers(con)
+        triggers = len(auditor.seen)
+        auditor.check(con, 'SELECT * FROM vehicles;')
+        auditor.check(con, 'SELECT * FROM vehicles WHERE model = ?;', ('Focus',))
+
+    # every statement of the summary, change log and rollup triggers seeks an index
+    assert triggers > 10
+    # a deliberate full read is allowed, a scan outside the allowlist fails the audit
+    assert 'SELECT * FROM vehicles;' in auditor.flagged
+    assert unexpected_plans(auditor.flagged, allowlist) == ['SELECT * FROM vehicles WHERE model = ?;']
+
+
+def test_vehicle_indexes(db):
+    # the ones left after migration 9, each seeked by a statement of the app
+    with db.pool.connection() as con:
+        indexes = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'vehicles' AND sql IS NOT NULL;")}
+        assert indexes == {'idx_vehicles_type_brand_model', 'idx_vehicles_date_type', 'idx_vehicles_price', 'idx_vehicles_brand_type_engine'}
+
+        auditor = QueryAuditor()
+        for query in ('{Brand} = BMW and {Price} > 10000', '{Type} = Car and {Fuel} = Diesel', '{Date Added} > 2021-01-01'):
+            condition, params = db.parse_filter(query)
+            auditor.check(con, 'SELECT COUNT(*) FROM vehicles WHERE {};'.format(condition), params)
+    assert auditor.flagged == {}
@@ -0,0 +1,37 @@
+"""WSGI entry point for running Carly under a multi-process server.
+
+    gunicorn --workers 4 --bind 0.0.0.0:8050 wsgi:server
+
+or, with gunicorn installed, from the repository root:  python wsgi.py [--workers 4] [--bind 0.0.0.0:8050]
+
+Every worker builds its own Carly (connection pool, caches) on import and its snapshot on first use, so don't
+use --preload: sqlite connections must not cross a fork. The workers share database.db (WAL), the session key stored in it
+and the data version, so writes in one worker invalidate the caches of the others.
+"""
+import argparse
+import os
+import sys
+
+DB_FILE = os.environ.get('CARLY_DB', 'database.db')
+
+
+def main():
+    # the workers import this module again, as 'wsgi', and build their own Carly
+    from gunicorn.app.wsgiapp import WSGIApplication
+
+    parser = argparse.ArgumentParser(description='Carly under gunicorn')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--bind', default='127.0.0.1:8050')
+    args = parser.parse_args()
+
+    sys.argv = ['gunicorn', '--workers', str(args.workers), '--bind', args.bind, 'wsgi:server']
+    WSGIApplication('%(prog)s [OPTIONS] [APP_MODULE]').run()
+
+
+if __name__ == '__main__':
+    main()
+else:
+    from app import Carly
+
+    web = Carly(title='Carly: My Car Project', db_file=DB_FILE)
+    server = web.app.server